@@ -0,0 +1,89 @@
+"""
+Generate synthetic archives of blog posts on disk for benchmarking tagging.
+
+Tags are drawn from a Zipf distribution so a few tags are on most posts and
+most tags are on a few, like a real archive.
+"""
+import bisect
+import os
+import random
+from datetime import datetime, timedelta
+
+WORDS = ("the dog ran jumped over a tunnel weave contact handler course "
+         "trial judge class novice open excellent masters time fault "
+         "refusal table pause teeter walk frame tire broad spread").split()
+
+
+class ZipfChooser(object):
+    """Choose items with probability proportional to 1/rank**exponent"""
+    def __init__(self, items, exponent=1.1, rng=random):
+        self.items = items
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(items) + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def choose(self):
+        return self.items[bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+    def sample(self, count):
+        chosen = []
+        while len(chosen) < min(count, len(self.items)):
+            item = self.choose()
+            if item not in chosen:
+                chosen.append(item)
+        return chosen
+
+
+def postText(rng, title, date, tags, linkTags, paragraphs, wordsPerParagraph):
+    """Return the text of a post linking to linkTags somewhere in its body"""
+    body = []
+    for i in range(paragraphs):
+        words = [rng.choice(WORDS) for j in range(wordsPerParagraph)]
+        body.append("<p>%s</p>\n" % " ".join(words))
+    for tag in linkTags:
+        i = rng.randrange(len(body))
+        body[i] = body[i].replace("</p>", " [[%s %s]]</p>" % (tag, rng.choice(WORDS)), 1)
+    return "%s\nmeta-creation_date: %s\nTags: %s\n\n%s" % (title,
+                                                          date.strftime("%m/%d/%Y %H:%M"),
+                                                          ", ".join(tags),
+                                                          "".join(body))
+
+
+def writeCorpus(directory,
+                numDocuments=1000,
+                numTags=500,
+                tagsPerDocument=3,
+                linksPerDocument=2,
+                paragraphs=5,
+                wordsPerParagraph=80,
+                categories=10,
+                exponent=1.1,
+                seed=0):
+    """
+    Write numDocuments posts into category sub directories of directory.
+    Return the list of their paths.
+    """
+    rng = random.Random(seed)
+    tags = ZipfChooser(["tag%d" % i for i in range(numTags)], exponent, rng)
+    start = datetime(2005, 1, 1)
+    paths = []
+    for i in range(numDocuments):
+        folder = os.path.join(directory, "category%d" % (i % categories))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        chosen = tags.sample(tagsPerDocument + linksPerDocument)
+        text = postText(rng,
+                        "Post %d" % i,
+                        start + timedelta(minutes=rng.randrange(60 * 24 * 365 * 8)),
+                        chosen[:tagsPerDocument],
+                        chosen[tagsPerDocument:],
+                        paragraphs,
+                        wordsPerParagraph)
+        path = os.path.join(folder, "post%d.txt" % i)
+        with open(path, "w") as fp:
+            fp.write(text)
+        paths.append(path)
+    return paths
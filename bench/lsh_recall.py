@@ -0,0 +1,80 @@
+"""
+Recall and speed of approximate (MinHashIndex) against exact related
+Documents on a synthetic archive of in-memory Documents.
+
+Recall is the fraction of each Document's exact related list that the
+approximate list also has, averaged over the sampled Documents.
+
+    python bench/lsh_recall.py [numDocuments] [scoring] [sample]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tagging import Document, RelatedIndex, SimilarityIndex, MinHashIndex
+from corpus import ZipfChooser
+
+# (numHashes, bandSize) pairs to try, most to least candidates
+SETTINGS = ((32, 1), (32, 2), (128, 2), (64, 2), (64, 3), (64, 4), (128, 8))
+
+
+def makeDocuments(numDocuments, numTags=2000, exponent=1.1, seed=0):
+    """Return list of Documents with 1 to 8 Zipf distributed tags"""
+    rng = random.Random(seed)
+    tags = ZipfChooser(["tag%d" % i for i in range(numTags)], exponent, rng)
+    start = datetime(2005, 1, 1)
+    return [Document(title="Post %d" % i,
+                     date=start + timedelta(minutes=rng.randrange(60 * 24 * 365 * 8)),
+                     tags=set(tags.sample(rng.randint(1, 8))))
+            for i in range(numDocuments)]
+
+
+def makeIndex(documents, scoring):
+    if scoring == 'count':
+        return RelatedIndex(documents)
+    return SimilarityIndex(documents, scoring=scoring)
+
+
+def recall(exact, approximate):
+    found = total = 0
+    for expected, got in zip(exact, approximate):
+        total += len(expected)
+        found += len(set(expected) & set(got))
+    return found / float(total or 1)
+
+
+if __name__ == "__main__":
+    numDocuments = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    scoring = sys.argv[2] if len(sys.argv) > 2 else 'idf'
+    sample = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    documents = makeDocuments(numDocuments)
+    sampled = random.Random(1).sample(documents, min(sample, numDocuments))
+
+    index = makeIndex(documents, scoring)
+    start = time.time()
+    if scoring == 'count':
+        exact = [index.related(doc) for doc in sampled]
+    else:
+        exact = index.relatedAll(sampled)
+    exactSeconds = (time.time() - start) * numDocuments / len(sampled)
+    print "%d documents, %s scoring, %d sampled" % (numDocuments, scoring, len(sampled))
+    print "%-16s %8s %10s %12s" % ("", "recall", "seconds", "candidates")
+    print "%-16s %8.3f %10.2f %12d" % ("exact", 1.0, exactSeconds, numDocuments)
+    for numHashes, bandSize in SETTINGS:
+        start = time.time()
+        minHash = MinHashIndex(index, numHashes=numHashes, bandSize=bandSize)
+        buildSeconds = time.time() - start
+        start = time.time()
+        if scoring == 'count':
+            approximate = [minHash.related(doc) for doc in sampled]
+        else:
+            approximate = minHash.relatedAll(sampled)
+        seconds = buildSeconds + (time.time() - start) * numDocuments / len(sampled)
+        candidates = sum(len(minHash.candidates(doc)) for doc in sampled) / len(sampled)
+        print "%-16s %8.3f %10.2f %12d" % ("%d hashes x %d" % (numHashes, bandSize),
+                                           recall(exact, approximate),
+                                           seconds,
+                                           candidates)
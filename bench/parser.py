@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of Document parsing in files/second on a synthetic corpus.
+
+LegacyDocument is the parser as it was before DocumentParser: string
+patterns passed to re on every line, the body regex compiled on every
+call and every file copied into a cStringIO.
+
+    python bench/parser.py [numDocuments] [paragraphs]
+"""
+import cStringIO
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tagging import Document
+from corpus import writeCorpus
+
+
+class LegacyDocument(object):
+    def __init__(self, file):
+        self.tags = set()
+        self.excerpt = ''
+        self.date = None
+        fp = cStringIO.StringIO(open(file).read())
+        self.tags = set(file.split(os.path.sep)[1:-1])
+        self._parseHead(fp)
+        self._parseBody(fp)
+        fp.close()
+
+    def _parseHead(self, fp):
+        self.title = fp.readline().strip()
+        line = fp.readline().strip()
+        date = tags = None
+        while line:
+            if not date:
+                date = self._extractDate(line)
+                if date:
+                    self.date = date
+            elif not tags:
+                tags = self._extractExplicitTags(line)
+                if tags:
+                    self.tags.update(tags)
+            line = fp.readline().strip()
+
+    def _parseBody(self, fp):
+        self.body = "".join(fp.readlines())
+        bodyTags = self._extractTagsFromBody(self.body)
+        if bodyTags:
+            self.tags.update(bodyTags)
+        excerpt = self._extractExcerpt(self.body)
+        if excerpt:
+            self.excerpt = excerpt
+
+    def _extractExplicitTags(self, line):
+        tags = ()
+        match = re.match('^Tags:', line)
+        if match:
+            tags = tuple([x.strip() for x in line[match.end():].split(",")])
+        return tags
+
+    def _extractDate(self, line):
+        match = re.search(r'^meta-creation_date:\s*(.*?)$', line)
+        if match:
+            for format in ("%m/%d/%Y %H:%M", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y"):
+                try:
+                    return datetime.strptime(match.groups(1)[0].strip(), format)
+                except ValueError:
+                    pass
+        raise Exception("Unexpected date format: " + line)
+
+    def _extractExcerpt(self, lines):
+        match = re.search(r'<p>(.*?)</p>?', lines, flags=re.IGNORECASE|re.MULTILINE|re.DOTALL)
+        return match and match.groups(1)[0] or ''
+
+    def _extractTagsFromBody(self, lines):
+        reg = re.compile(r'(\[\[([\w-]+)[^[]*?\]\])+', flags=re.MULTILINE)
+        return tuple([x.group(2) for x in re.finditer(reg, lines)])
+
+
+def filesPerSecond(parse, paths, repeat=3):
+    """Best of repeat runs of parse over every path"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for path in paths:
+            parse(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(paths) / best
+
+
+if __name__ == "__main__":
+    numDocuments = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    directory = tempfile.mkdtemp()
+    try:
+        paths = writeCorpus(directory, numDocuments=numDocuments, paragraphs=paragraphs)
+        for path in paths[:50]:
+            legacy, doc = LegacyDocument(path), Document(file=path, lazy=True)
+            assert (legacy.tags, legacy.excerpt) == (doc.tags, doc.excerpt), path
+        before = filesPerSecond(LegacyDocument, paths)
+        print "%d documents, %d paragraphs each" % (numDocuments, paragraphs)
+        print "%-10s %10.0f files/sec" % ("before", before)
+        for name, parse in (("eager", lambda path: Document(file=path)),
+                            ("lazy", lambda path: Document(file=path, lazy=True))):
+            after = filesPerSecond(parse, paths)
+            print "%-10s %10.0f files/sec %5.2fx" % (name, after, after / before)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,157 @@
+"""
+Time every stage of the tagging pipeline on a synthetic archive and save
+the results as JSON so revisions can be compared.
+
+    python bench/pipeline.py --documents 5000 --output before.json
+    python bench/pipeline.py --documents 5000 --output after.json --compare before.json
+
+Peak memory is the process's maximum resident size after each stage, so
+it only grows; a stage that raises it is the one that needed the memory.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tagging import buildDocumentTree, generateTagResourcesHTML, htmlCloud, tagsToHTML, sortedTags, FRAGMENT_CACHE
+from corpus import writeCorpus
+
+# stages slower than this fraction of the compared run are flagged
+REGRESSION = 0.10
+
+
+def peakMemory():
+    """Return the maximum resident size of this process so far in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def revision():
+    """Return the git revision of the tree being measured, None outside git"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stages(object):
+    """Runs and records the stages in order"""
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, items, function, *args, **kwargs):
+        """Call function, record its time against items processed, return its result"""
+        start = time.time()
+        result = function(*args, **kwargs)
+        seconds = time.time() - start
+        count = items(result) if callable(items) else items
+        self.results.append({"stage": name,
+                             "seconds": seconds,
+                             "items": count,
+                             "perSecond": count / seconds if seconds else None,
+                             "peakBytes": peakMemory()})
+        return result
+
+
+def relatedToHTML(docs):
+    return "".join(["""<li><a href="%s">%s</a></li>""" % (doc.url, doc.title) for doc in docs])
+
+
+def writeDocuments(tree):
+    for doc in tree.documents:
+        doc.write(doc.file,
+                  formattedTags=tagsToHTML(sortedTags(doc.tags)),
+                  formattedRelated=relatedToHTML(doc.related))
+    return tree.documents
+
+
+def runPipeline(directory, options):
+    stages = Stages()
+    tree = stages.run("buildDocumentTree", lambda tree: len(tree.documents),
+                      buildDocumentTree, os.path.join(directory, "posts"),
+                      baseURL="/blog/", workers=options.workers, lazy=options.lazy)
+    cloud = stages.run("cloudify", len, tree.cloudify)
+    stages.run("htmlCloud", len(cloud), htmlCloud, sorted(cloud))
+    stages.run("updateRelated", len(tree.documents), tree.updateRelated, scoring=options.scoring)
+    stages.run("generateTagResourcesHTML", len(tree.tags),
+               generateTagResourcesHTML, tree, tree.tags, os.path.join(directory, "tags"))
+    stages.run("Document.write", len, writeDocuments, tree)
+    return stages.results
+
+
+def compare(results, previous):
+    """Print each stage's time against previous results, flagging regressions"""
+    before = dict((stage["stage"], stage) for stage in previous["stages"])
+    print "%-26s %10s %10s %8s" % ("compared to %s" % (previous.get("revision") or "previous"),
+                                   "before", "after", "change")
+    for stage in results["stages"]:
+        old = before.get(stage["stage"])
+        if not old:
+            continue
+        change = (stage["seconds"] - old["seconds"]) / old["seconds"] if old["seconds"] else 0.0
+        print "%-26s %9.3fs %9.3fs %+7.1f%%%s" % (stage["stage"], old["seconds"], stage["seconds"],
+                                                 change * 100, "  SLOWER" if change > REGRESSION else "")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=500)
+    parser.add_argument("--tags-per-document", type=int, default=3)
+    parser.add_argument("--links-per-document", type=int, default=2, help="[[tag]] links in each body")
+    parser.add_argument("--paragraphs", type=int, default=5)
+    parser.add_argument("--words-per-paragraph", type=int, default=80)
+    parser.add_argument("--exponent", type=float, default=1.1, help="Zipf exponent of tag popularity")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="processes parsing documents")
+    parser.add_argument("--lazy", action="store_true", help="parse without keeping bodies")
+    parser.add_argument("--scoring", default="count", help="updateRelated scoring")
+    parser.add_argument("--output", help="file to save the results JSON to")
+    parser.add_argument("--compare", help="results JSON of a previous run to compare with")
+    options = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        writeCorpus(os.path.join(directory, "posts"),
+                    numDocuments=options.documents,
+                    numTags=options.tags,
+                    tagsPerDocument=options.tags_per_document,
+                    linksPerDocument=options.links_per_document,
+                    paragraphs=options.paragraphs,
+                    wordsPerParagraph=options.words_per_paragraph,
+                    exponent=options.exponent,
+                    seed=options.seed)
+        FRAGMENT_CACHE.clear()
+        stages = runPipeline(directory, options)
+    finally:
+        shutil.rmtree(directory)
+
+    results = {"revision": revision(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "options": vars(options),
+               "stages": stages}
+    print "%-26s %10s %8s %12s %10s" % ("stage", "seconds", "items", "items/sec", "peak MB")
+    for stage in stages:
+        print "%-26s %10.3f %8d %12.0f %10.1f" % (stage["stage"], stage["seconds"], stage["items"],
+                                                  stage["perSecond"] or 0, stage["peakBytes"] / 1048576.0)
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(results, json.load(fp))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Time rendering every tag page and the tag cloud of a synthetic archive
+of in-memory Documents with compiled templates against safe_substitute.
+
+The legacy run renders every template with its safe_substitute and joins
+every tag URL again, as before compileTemplate and TAG_URL_CACHE. Both
+runs skip the FRAGMENT_CACHE so every Document is rendered on every page
+of its tags.
+
+    python bench/templates.py [numDocuments] [pageSize]
+"""
+import functools
+import os
+import sys
+import time
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tagging
+from tagging import DocumentTree, tagPages, tagResourceHTML, tagsToHTML, documentToHTML, htmlCloud
+from lsh_recall import makeDocuments
+
+
+def legacyTagFilePath(name, baseURL="/blog/tags/", suffix="html"):
+    return urlparse.urljoin(baseURL, name+"."+suffix)
+
+
+def renderAll(tree, pageSize, tagToUrl):
+    """Render every page of every tag and the cloud, return the bytes rendered"""
+    docFormatter = functools.partial(documentToHTML,
+                                     tagFormatter=functools.partial(tagsToHTML, tagToUrl=tagToUrl, cache=None),
+                                     cache=None)
+    size = 0
+    for tag in tree.tags:
+        docs = tree.query(tags=[tag])
+        for number, pageDocs in tagPages(docs, pageSize):
+            size += len(tagResourceHTML(tag, docs, docFormatter=docFormatter,
+                                        pageSize=pageSize, page=number, tagToUrl=tagToUrl))
+    cloud = [(tag, bucket, tagToUrl(tag)) for tag, bucket, url in tree.cloudify()]
+    return size + len(htmlCloud(cloud))
+
+
+def best(function, repeat=3):
+    """Best of repeat runs of function, and its result"""
+    seconds = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return seconds, result
+
+
+if __name__ == "__main__":
+    numDocuments = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pageSize = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    tree = DocumentTree()
+    for i, doc in enumerate(makeDocuments(numDocuments)):
+        doc.url = "/blog/%d.html" % i
+        doc.excerpt = "Excerpt of post %d." % i
+        tree.add(doc)
+
+    compileTemplate = tagging.compileTemplate
+    tagging.compileTemplate = lambda template: template.safe_substitute
+    try:
+        before, legacy = best(lambda: renderAll(tree, pageSize, legacyTagFilePath))
+    finally:
+        tagging.compileTemplate = compileTemplate
+    after, compiled = best(lambda: renderAll(tree, pageSize, tagging.tagFilePath))
+    assert legacy == compiled
+
+    pages = sum(len(tagPages(tree.query(tags=[tag]), pageSize)) for tag in tree.tags)
+    print "%d documents, %d tags, %d pages of %d, %.1f MB" % (numDocuments, len(tree.tags), pages,
+                                                           pageSize, compiled / 1048576.0)
+    print "%-10s %8.3fs %10.0f pages/sec" % ("before", before, pages / before)
+    print "%-10s %8.3fs %10.0f pages/sec %5.2fx" % ("after", after, pages / after, before / after)
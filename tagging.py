@@ -1,12 +1,51 @@
+from array import array
+from collections import OrderedDict
+import bisect
+import cProfile
 import cStringIO
-from datetime import datetime
+import errno
+import functools
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import hashlib
+import heapq
+import itertools
+import json
 import math
+import mmap
+import multiprocessing
 import os
+import pstats
+import random
 import re
+import shutil
+import sqlite3
+import stat
 import string
+import struct
 import sys
+import tempfile
+import threading
+import time
 import urlparse
-from operator import attrgetter
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 class DocumentTree(object):
@@ -14,16 +53,314 @@ class DocumentTree(object):
     A collection of Documents and tagging information about them.
     Once constructed an instance can be used to generate a tag cloud
     and static HTML pages of Documents containing each tag.
+
+    Documents are numbered as they are added and each tag's Documents are
+    kept as an array of those numbers. self.tags presents them as a
+    read only dict of tag names to sequences of Documents.
+
+    If normalizer (a TagNormalizer) is supplied Documents are listed under,
+    and have their tags replaced by, the tags it makes of theirs.
     """
-    def __init__(self):
-        self.tags = {} # dict of tag names to Documents
+    def __init__(self, normalizer=None):
+        self.normalizer = normalizer
         self.documents = []
+        self._docs = [] # Documents by id, None once removed
+        self._ids = {} # dict of Documents to ids
+        self._docTags = [] # array of tag ids each Document is listed under by id
+        self._tagIds = {} # dict of tag names to ids
+        self._tagNames = [] # tag names by id, each shared by every Document with the tag
+        self._postings = [] # array of Document ids having each tag by tag id
+        self._tagCounts = array('I') # number of Documents having each tag by tag id
+        self._sourceTags = {} # dict of ids to tags before normalizing, if it changed them
+        self._files = {} # dict of file names to Documents
+        self.tags = TagIndex(self) # dict-like view of tag names to Documents
+        self._version = 0 # changed whenever Documents or tags change
+        self._queryIndex = None
+        self.clearDirty()
+
+    def clearDirty(self):
+        """
+        Forget what changed. Afterwards add/remove/update record:
+          dirtyTags      - tags whose pages need regenerating (tags no longer
+                           in self.tags had their last Document removed)
+          dirtyDocuments - Documents whose related lists need updating and
+                           whose files need rewriting
+          dirtyCloud     - True if any tag's Document count changed
+        """
+        self.dirtyTags = set()
+        self._dirtyDocuments = set() # Documents updated in place
+        self.dirtyCloud = False
+
+    @property
+    def dirtyDocuments(self):
+        """
+        Set of the Documents updated or having any of dirtyTags: Documents
+        sharing a tag with a changed one may gain or lose it as related.
+        """
+        documents = set(self._dirtyDocuments)
+        for tag in self.dirtyTags:
+            documents.update(self.tags.get(tag, ()))
+        return documents
 
     def add(self, document):
         """Add a Document into this collection"""
         self.documents.append(document)
-        for tag in document.tags:
-            self.tags.setdefault(tag, []).append(document)
+        docId = len(self._docs)
+        self._docs.append(document)
+        self._ids[document] = docId
+        self._docTags.append(array('I'))
+        self._list(docId, document)
+        self._markDirty(frozenset(), frozenset(document.tags))
+
+    def remove(self, document):
+        """Remove a Document (or the Document for the same file) from this collection"""
+        found = self._find(document)
+        if found is None:
+            raise ValueError("Document not in DocumentTree: %r" % (document,))
+        self.documents.remove(found)
+        docId = self._ids.pop(found)
+        self._docs[docId] = None
+        self._sourceTags.pop(docId, None)
+        oldTags = self._unlist(docId, found)
+        for tagId in self._docTags[docId]:
+            self._removePosting(tagId, docId)
+        self._docTags[docId] = array('I')
+        self._markDirty(oldTags, frozenset())
+
+    def update(self, document):
+        """
+        Re-index a Document whose tags or content changed since it was added.
+        A different Document for the same file replaces the one already added.
+        Documents not in this collection are added.
+        """
+        previous = self._find(document)
+        if previous is None:
+            return self.add(document)
+        docId = self._ids.pop(previous)
+        oldTags = self._unlist(docId, previous)
+        sourceTags = None
+        if previous is not document:
+            self.documents[self.documents.index(previous)] = document
+            self._docs[docId] = document
+        elif oldTags == document.tags:
+            # tags untouched since listed, keep those it was added with
+            sourceTags = self._sourceTags.get(docId)
+        self._ids[document] = docId
+        self._list(docId, document, sourceTags)
+        document.version += 1
+        self._markDirty(oldTags, frozenset(document.tags))
+        self._dirtyDocuments.add(document)
+
+    def renormalize(self, normalizer=None):
+        """
+        List every Document again under the tags normalizer (default
+        self.normalizer, replacing it if given) makes of the tags it was
+        added with, without reading any files. Documents whose tags change
+        are marked dirty and have their version bumped.
+        """
+        if normalizer is not None:
+            self.normalizer = normalizer
+        for docId, document in enumerate(self._docs):
+            if document is None:
+                continue
+            oldTags = frozenset(document.tags)
+            self._list(docId, document, self._sourceTags.get(docId, oldTags))
+            if oldTags != document.tags:
+                document.version += 1
+                self._markDirty(oldTags, frozenset(document.tags))
+                self._dirtyDocuments.add(document)
+
+    def __contains__(self, document):
+        return document in self._ids
+
+    def query(self, tags=(), anyTags=(), excludeTags=(), since=None, before=None, offset=0, limit=None):
+        """
+        Return list of the Documents newest first having all of tags, any of
+        anyTags (if given) and none of excludeTags, dated from since up to but
+        not including before (datetimes, if given), skipping the first offset
+        and at most limit of them. See QueryIndex.
+        """
+        return self.queryIndex().query(tags, anyTags, excludeTags, since, before, offset, limit)
+
+    def queryIndex(self):
+        """Return the QueryIndex of the Documents as they are now"""
+        if self._queryIndex is None or self._queryIndex.version != self._version:
+            self._queryIndex = QueryIndex(self)
+        return self._queryIndex
+
+    def save(self, fileName):
+        """
+        Write a snapshot of this tree's Documents and tags to fileName (see
+        TreeSnapshot) replacing it atomically.
+        """
+        strings = {} # dict of strings to their numbers
+        stringData = []
+        def number(string):
+            if string is None:
+                return NoString
+            if isinstance(string, unicode):
+                string = string.encode('utf-8')
+            found = strings.get(string)
+            if found is None:
+                found = strings[string] = len(stringData)
+                stringData.append(string)
+            return found
+        # sorted by their UTF-8 bytes as TreeSnapshot.findTag searches them
+        tags = sorted([(tag.encode('utf-8') if isinstance(tag, unicode) else tag, tag) for tag in self._tagIds])
+        tagNumbers = dict((tag, tagNumber) for tagNumber, (encoded, tag) in enumerate(tags))
+        docNumbers = dict((self._ids[doc], docNumber) for docNumber, doc in enumerate(self.documents))
+        tagRecords = []
+        postings = array('I')
+        for encoded, tag in tags:
+            ids = self.documentsTagged(tag)
+            tagRecords.append(SnapshotTag.pack(number(encoded), len(postings), len(ids)))
+            postings.extend([docNumbers[docId] for docId in ids])
+        docRecords = []
+        docTags = array('I')
+        for doc in self.documents:
+            tagged = sorted([tagNumbers[self._tagNames[tagId]] for tagId in self._docTags[self._ids[doc]]])
+            docRecords.append(SnapshotDocument.pack(number(doc.title), number(doc.url), number(doc.file),
+                                                    number(doc.excerpt), dateToMicroseconds(doc.date),
+                                                    len(docTags), len(tagged)))
+            docTags.extend(tagged)
+        ends = []
+        end = 0
+        for string in stringData:
+            end += len(string)
+            ends.append(end)
+        sections = [_uint32s(ends), "".join(stringData), "".join(docRecords),
+                    "".join(tagRecords), _uint32s(postings), _uint32s(docTags)]
+        offsets = []
+        offset = SnapshotHeader.size
+        for section in sections:
+            offsets.append(offset)
+            offset += len(section)
+        header = SnapshotHeader.pack(SnapshotMagic, len(self.documents), len(tags), len(stringData), *offsets)
+        atomicWrite(fileName, [header] + sections)
+
+    @classmethod
+    def load(cls, fileName, docClass=None, normalizer=None):
+        """
+        Return a DocumentTree of the Documents (of docClass, default Document)
+        in a snapshot written by save. Their tags are as saved; normalizer
+        only applies to Documents added or updated afterwards.
+        """
+        snapshot = TreeSnapshot(fileName, docClass=docClass)
+        try:
+            tree = cls()
+            for doc in snapshot.documents:
+                tree.add(doc)
+        finally:
+            snapshot.close()
+        tree.normalizer = normalizer
+        tree.clearDirty()
+        return tree
+
+    @classmethod
+    def merge(cls, trees, normalizer=None):
+        """
+        Return a DocumentTree of the Documents of trees (e.g. shards built
+        from separate roots) without listing them again: each tree's
+        Document ids are offset by the number of ids before it, its
+        postings are appended to those of the same tags and its tag counts
+        added to theirs. cloudify, query and updateRelated then cover every
+        tree. The Documents are shared with trees, which shouldn't be
+        changed afterwards. normalizer defaults to the first tree's.
+        """
+        if normalizer is None and trees:
+            normalizer = trees[0].normalizer
+        merged = cls(normalizer=normalizer)
+        for tree in trees:
+            offset = len(merged._docs)
+            for fileName in tree._files:
+                if fileName in merged._files:
+                    raise ValueError("File in more than one DocumentTree: %r" % (fileName,))
+            tagMap = {} # dict of tree's tag ids to merged tag ids
+            for tag, tagId in tree._tagIds.items():
+                mergedId = merged._tagIds.get(tag)
+                if mergedId is None:
+                    mergedId = merged._tagIds[tag] = len(merged._tagNames)
+                    merged._tagNames.append(tag)
+                    merged._postings.append(array('I'))
+                    merged._tagCounts.append(0)
+                tagMap[tagId] = mergedId
+                merged._postings[mergedId].extend([docId + offset for docId in tree._postings[tagId]])
+                merged._tagCounts[mergedId] += tree._tagCounts[tagId]
+            for doc, docId in tree._ids.items():
+                if doc in merged._ids:
+                    raise ValueError("Document in more than one DocumentTree: %r" % (doc,))
+                merged._ids[doc] = docId + offset
+            merged._docs.extend(tree._docs)
+            merged.documents.extend(tree.documents)
+            merged._docTags.extend([array('I', [tagMap[tagId] for tagId in tagIds]) for tagIds in tree._docTags])
+            merged._files.update(tree._files)
+            for docId, tags in tree._sourceTags.items():
+                merged._sourceTags[docId + offset] = tags
+        merged._version += 1
+        return merged
+
+    def documentsTagged(self, tag):
+        """Return array of ids of the Documents having tag"""
+        tagId = self._tagIds.get(tag)
+        return self._postings[tagId] if tagId is not None else array('I')
+
+    def _find(self, document):
+        if document in self._ids:
+            return document
+        return document.file and self._files.get(document.file) or None
+
+    def _list(self, docId, document, tags=None):
+        """
+        List Document under its tags (or tags), normalized, replacing them
+        with the shared tag names.
+        """
+        tags = document.tags if tags is None else tags
+        self._sourceTags.pop(docId, None)
+        if self.normalizer is not None:
+            normalized = self.normalizer.normalize(tags)
+            if normalized is not tags:
+                self._sourceTags[docId] = frozenset(tags)
+                tags = normalized
+        tagIds = self._docTags[docId]
+        old = set(tagIds)
+        new = []
+        for tag in tags:
+            tagId = self._tagIds.get(tag)
+            if tagId is None:
+                tagId = self._tagIds[tag] = len(self._tagNames)
+                self._tagNames.append(tag)
+                self._postings.append(array('I'))
+                self._tagCounts.append(0)
+            if tagId not in old:
+                self._postings[tagId].append(docId)
+                self._tagCounts[tagId] += 1
+            new.append(tagId)
+        for tagId in old.difference(new):
+            self._removePosting(tagId, docId)
+        self._docTags[docId] = array('I', new)
+        document.tags = set([self._tagNames[tagId] for tagId in new])
+        if document.file:
+            self._files[document.file] = document
+
+    def _unlist(self, docId, document):
+        """Forget Document's file returning the tags it's listed under"""
+        if self._files.get(document.file) is document:
+            del self._files[document.file]
+        return frozenset([self._tagNames[tagId] for tagId in self._docTags[docId]])
+
+    def _removePosting(self, tagId, docId):
+        postings = self._postings[tagId]
+        postings.remove(docId)
+        self._tagCounts[tagId] -= 1
+        if not postings:
+            del self._tagIds[self._tagNames[tagId]]
+
+    def _markDirty(self, oldTags, newTags):
+        self._version += 1
+        tags = oldTags.union(newTags)
+        self.dirtyTags.update(tags)
+        if oldTags != newTags:
+            self.dirtyCloud = True
 
     def cloudify(self,
                  minCount=2,
@@ -33,32 +370,895 @@ class DocumentTree(object):
                  blackList=[],
                  algo='log'):
         """Output a list of tuples of the form:
-        [(tagname, bucketNumber, url), ...]"""
+        [(tagname, bucketNumber, url), ...]
+        See cloudBuckets for the algorithms."""
+        if not self._tagIds:
+            return []
+        blackList = set(blackList)
+        listed = [tagId for tag, tagId in self._tagIds.items() if tag in blackList]
+        if numpy is not None:
+            counts = numpy.frombuffer(self._tagCounts, dtype=numpy.dtype(self._tagCounts.typecode))
+            candidates = counts >= max(minCount, 1)
+            candidates[listed] = False
+            buckets = cloudBuckets(counts, numBuckets, algo, candidates)
+            tagIds = numpy.flatnonzero(candidates & (buckets >= 1)).tolist()
+            buckets = buckets.tolist()
+        else:
+            counts = self._tagCounts
+            candidates = [count >= max(minCount, 1) for count in counts]
+            for tagId in listed:
+                candidates[tagId] = False
+            buckets = cloudBuckets(counts, numBuckets, algo, candidates)
+            tagIds = [tagId for tagId, bucket in enumerate(buckets) if candidates[tagId] and bucket >= 1]
         out = []
-        maxCount = max([len(x) for x in self.tags.values()])
-        bucketSize = maxCount / float("%d" % numBuckets)
-        for tag, listOfDocs in self.tags.items():
-            count = len(listOfDocs)
-            if algo == 'log':
-                bucket = int(math.log(count))
+        for tagId in tagIds:
+            tag = self._tagNames[tagId]
+            out.append((tag, buckets[tagId], baseURL+tag+suffix))
+        return out
+
+    def tagCounts(self):
+        """Return dict of tag names to the number of Documents with the tag"""
+        return dict((tag, self._tagCounts[tagId]) for tag, tagId in self._tagIds.items())
+
+    def updateRelated(self, limit=6, ignoreTags=[], documents=None, scoring='count', approximate=False):
+        """
+        Set each Document's related list to the (at most limit) other Documents
+        sharing the most tags with it, newest first when they share as many.
+        Tags in ignoreTags are not used to find candidates but still count
+        towards the number of shared tags.
+        Any other scoring ranks by weighted tags instead, see SimilarityIndex.
+        If approximate only Documents with similar tag sets are scored, see
+        MinHashIndex; it may be a dict of MinHashIndex options (numHashes,
+        bandSize, seed). The defaults favour speed and miss related Documents:
+        on bench/lsh_recall.py's 20000 Documents they find about 55% (idf) to
+        60% (count) of the exact related lists, {'numHashes': 128, 'bandSize': 2}
+        about 95% in four times as long.
+        Only the related lists of documents are updated if supplied
+        (e.g. self.dirtyDocuments).
+        """
+        if documents is None:
+            documents = self.documents
+        documents = list(documents)
+        with INSTRUMENTS.stage('updateRelated'):
+            if scoring == 'count':
+                index = RelatedIndex(self.documents, ignoreTags=ignoreTags)
+            else:
+                index = SimilarityIndex(self.documents, scoring=scoring, ignoreTags=ignoreTags)
+            if approximate:
+                options = approximate if isinstance(approximate, dict) else {}
+                index = MinHashIndex(index, **options)
+            if scoring == 'count':
+                for doc in documents:
+                    doc.related = index.related(doc, limit=limit)
             else:
-                bucket = int(count / bucketSize)
-            # print tag, count, bucket
-            if count < minCount or bucket < 1 or tag in blackList:
+                for doc, related in zip(documents, index.relatedAll(documents, limit=limit)):
+                    doc.related = related
+        INSTRUMENTS.count('relatedDocuments', len(documents))
+
+
+def cloudBuckets(counts, numBuckets=6, algo='log', candidates=None):
+    """
+    Return the tag cloud bucket of each of counts (Documents per tag, 0 for
+    unused tags):
+      'log'      - int(log(count))
+      'quantile' - 1 to numBuckets by the count's rank among the counts of
+                   candidates (a sequence of booleans, default all used tags)
+                   so each bucket has about as many tags
+      otherwise  - int(count / (largest count / numBuckets))
+    With NumPy counts and candidates are arrays and an array is returned,
+    computed in one batch.
+    """
+    if numpy is not None and isinstance(counts, numpy.ndarray):
+        counts = counts.astype(numpy.float64)
+        if algo == 'log':
+            return numpy.log(numpy.maximum(counts, 1)).astype(int)
+        if algo == 'quantile':
+            if candidates is None:
+                candidates = counts > 0
+            ranked = numpy.sort(counts[candidates])
+            if not len(ranked):
+                return numpy.zeros(len(counts), dtype=int)
+            ranks = numpy.searchsorted(ranked, counts, side='left')
+            return 1 + ranks * numBuckets // len(ranked)
+        bucketSize = counts.max() / float("%d" % numBuckets)
+        return (counts / bucketSize).astype(int)
+    if algo == 'log':
+        return [int(math.log(max(count, 1))) for count in counts]
+    if algo == 'quantile':
+        if candidates is None:
+            candidates = [count > 0 for count in counts]
+        ranked = sorted([count for count, candidate in zip(counts, candidates) if candidate])
+        if not ranked:
+            return [0] * len(counts)
+        return [1 + bisect.bisect_left(ranked, count) * numBuckets // len(ranked) for count in counts]
+    bucketSize = max(counts) / float("%d" % numBuckets)
+    return [int(count / bucketSize) for count in counts]
+
+
+class TagIndex(object):
+    """Read only dict-like view of a DocumentTree's tag names to its Documents"""
+    def __init__(self, tree):
+        self._tree = tree
+
+    def __getitem__(self, tag):
+        tagId = self._tree._tagIds[tag]
+        return Postings(self._tree._docs, self._tree._postings[tagId])
+
+    def get(self, tag, default=None):
+        if tag in self:
+            return self[tag]
+        return default
+
+    def __contains__(self, tag):
+        return tag in self._tree._tagIds
+
+    def __iter__(self):
+        return iter(self._tree._tagIds)
+
+    def __len__(self):
+        return len(self._tree._tagIds)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[tag] for tag in self]
+
+    def items(self):
+        return [(tag, self[tag]) for tag in self]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for tag in self:
+            yield self[tag]
+
+    def iteritems(self):
+        for tag in self:
+            yield tag, self[tag]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class Postings(object):
+    """Read only sequence of the Documents for an array of Document ids"""
+    def __init__(self, docs, ids):
+        self._docs = docs
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        docs = self._docs
+        for docId in self.ids:
+            yield docs[docId]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._docs[docId] for docId in self.ids[index]]
+        return self._docs[self.ids[index]]
+
+    def __contains__(self, document):
+        for doc in self:
+            if doc is document:
+                return True
+        return False
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class QueryIndex(object):
+    """
+    A DocumentTree's Documents numbered newest first (in the order they were
+    added when dated the same) with each tag's Documents as a sorted array of
+    those numbers. Date ranges are found by bisecting the dates, so are
+    ranges of numbers, and tags are combined by walking their arrays from
+    the smallest with galloping cursors, stopping once there are enough.
+    Made by DocumentTree.queryIndex after any change to the tree.
+    """
+    def __init__(self, tree):
+        self.version = tree._version
+        docIds = [docId for docId, doc in enumerate(tree._docs) if doc is not None]
+        docIds.sort(key=lambda docId: tree._docs[docId].date, reverse=True)
+        self.documents = [tree._docs[docId] for docId in docIds]
+        numbers = [0] * len(tree._docs)
+        for number, docId in enumerate(docIds):
+            numbers[docId] = number
+        # negated so they ascend with the numbers
+        self.dates = [-dateToMicroseconds(doc.date) for doc in self.documents]
+        self.postings = {} # dict of tag names to sorted arrays of numbers
+        for tag, tagId in tree._tagIds.items():
+            self.postings[tag] = array('I', sorted([numbers[docId] for docId in tree._postings[tagId]]))
+
+    def dateRange(self, since=None, before=None):
+        """Return (start, end) numbers of the Documents dated from since up to before"""
+        start, end = 0, len(self.documents)
+        if before is not None:
+            start = bisect.bisect_right(self.dates, -dateToMicroseconds(before))
+        if since is not None:
+            end = bisect.bisect_right(self.dates, -dateToMicroseconds(since))
+        return start, max(start, end)
+
+    def tagged(self, tag, start=0, end=None):
+        """Return (array, first, last) bounding the numbers of tag's Documents from start to end"""
+        values = self.postings.get(tag, array('I'))
+        if end is None:
+            end = len(self.documents)
+        return values, bisect.bisect_left(values, start), bisect.bisect_left(values, end)
+
+    def numbers(self, tags=(), anyTags=(), excludeTags=(), since=None, before=None):
+        """Yield the numbers of the Documents matching as query, ascending"""
+        start, end = self.dateRange(since, before)
+        required = sorted([self.tagged(tag, start, end) for tag in tags],
+                          key=lambda (values, first, last): last - first)
+        alternatives = [self.tagged(tag, start, end) for tag in anyTags]
+        if required:
+            candidates = _iterRange(*required[0])
+            required = required[1:]
+        elif alternatives:
+            candidates = _uniqueMerge([_iterRange(*bounds) for bounds in alternatives])
+            alternatives = []
+        else:
+            candidates = iter(xrange(start, end))
+        required = [GallopingCursor(*bounds) for bounds in required]
+        alternatives = [GallopingCursor(*bounds) for bounds in alternatives]
+        excluded = [GallopingCursor(*self.tagged(tag, start, end)) for tag in excludeTags]
+        for number in candidates:
+            if not all([cursor.advanceTo(number) for cursor in required]):
                 continue
-            out.append((tag, bucket, baseURL+tag+suffix))
+            if alternatives and not any([cursor.advanceTo(number) for cursor in alternatives]):
+                continue
+            if any([cursor.advanceTo(number) for cursor in excluded]):
+                continue
+            yield number
+
+    def query(self, tags=(), anyTags=(), excludeTags=(), since=None, before=None, offset=0, limit=None):
+        """Return list of Documents as DocumentTree.query"""
+        numbers = self.numbers(tags, anyTags, excludeTags, since, before)
+        stop = None if limit is None else offset + limit
+        return [self.documents[number] for number in itertools.islice(numbers, offset, stop)]
+
+
+class GallopingCursor(object):
+    """
+    Cursor over values[first:last] (sorted ascending) for finding increasing
+    values: each search gallops ahead in doubling steps then bisects, so
+    finding k values costs O(k log(n / k)) rather than O(n).
+    """
+    def __init__(self, values, first=0, last=None):
+        self.values = values
+        self.position = first
+        self.last = len(values) if last is None else last
+
+    def advanceTo(self, value):
+        """Move to the first value not less than value, returning True if it is value"""
+        values, position, last = self.values, self.position, self.last
+        if position >= last or values[position] >= value:
+            return position < last and values[position] == value
+        step = 1
+        while position + step < last and values[position + step] < value:
+            position += step
+            step *= 2
+        position = bisect.bisect_left(values, value, position + 1, min(position + step, last))
+        self.position = position
+        return position < last and values[position] == value
+
+
+def _iterRange(values, first, last):
+    """Yield values[first:last] without copying them"""
+    for i in xrange(first, last):
+        yield values[i]
+
+def _uniqueMerge(iterables):
+    """Yield the values of sorted iterables in order without repeats"""
+    previous = None
+    for value in heapq.merge(*iterables):
+        if value != previous:
+            yield value
+            previous = value
+
+
+# Snapshot file layout, all little endian:
+#   header        SnapshotHeader
+#   string ends   uint32 per string, end of each string in the string data
+#   string data   the strings (UTF-8) one after another
+#   documents     SnapshotDocument per Document
+#   tags          SnapshotTag per tag, sorted by name
+#   postings      uint32 Document numbers of each tag in turn
+#   document tags uint32 tag numbers of each Document in turn
+SnapshotMagic = "TAGTREE1"
+SnapshotHeader = struct.Struct("<8s3I6Q") # magic, counts of documents, tags, strings, section offsets
+SnapshotDocument = struct.Struct("<4IqII") # title, url, file, excerpt strings, date, tags start and count
+SnapshotTag = struct.Struct("<3I") # name string, postings start and count
+NoString = 0xffffffff # string number of None
+
+def _uint32s(values):
+    """Return little endian bytes of an array of unsigned 32 bit values"""
+    values = array('I', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+class TreeSnapshot(object):
+    """
+    Read only view of a DocumentTree saved with DocumentTree.save, memory
+    mapped so opening it reads nothing but the header. tags is a dict-like
+    view of tag names to Documents found by binary search of the sorted tag
+    table; Documents (of docClass, default Document) are made from their
+    records as they are first used. Related lists aren't saved.
+    Strings are saved and read back as str, unicode ones UTF-8 encoded.
+    """
+    def __init__(self, fileName, docClass=None):
+        self.docClass = docClass or Document
+        with open(fileName, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.numDocuments, self.numTags, self.numStrings, self._stringEnds, self._strings,
+         self._documents, self._tags, self._postings, self._docTags) = SnapshotHeader.unpack_from(self._map)
+        if magic != SnapshotMagic:
+            self._map.close()
+            raise ValueError("Not a DocumentTree snapshot: %r" % (fileName,))
+        self._cache = {} # dict of Document numbers to Documents
+        self.documents = SnapshotDocuments(self)
+        self.tags = SnapshotTagIndex(self)
+
+    def close(self):
+        self._map.close()
+
+    def string(self, number):
+        """Return string number, None for NoString"""
+        if number == NoString:
+            return None
+        ends = self._stringEnds
+        start = number and struct.unpack_from("<I", self._map, ends + 4 * (number - 1))[0]
+        end = struct.unpack_from("<I", self._map, ends + 4 * number)[0]
+        return self._map[self._strings + start:self._strings + end]
+
+    def uint32s(self, offset, start, count):
+        """Return array of count values from the start'th of the uint32 section at offset"""
+        values = array('I')
+        values.fromstring(self._map[offset + 4 * start:offset + 4 * (start + count)])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def document(self, number):
+        """Return Document number, made from its record the first time"""
+        doc = self._cache.get(number)
+        if doc is None:
+            if not 0 <= number < self.numDocuments:
+                raise IndexError(number)
+            (title, url, file, excerpt, date,
+             start, count) = SnapshotDocument.unpack_from(self._map, self._documents + SnapshotDocument.size * number)
+            tags = [self.tagName(tag) for tag in self.uint32s(self._docTags, start, count)]
+            doc = self._cache[number] = self.docClass.fromRecord({'title': self.string(title),
+                                                                  'date': dateFromMicroseconds(date),
+                                                                  'tags': tags,
+                                                                  'excerpt': self.string(excerpt)},
+                                                                 file=self.string(file),
+                                                                 url=self.string(url))
+        return doc
+
+    def tagName(self, number):
+        return self.string(SnapshotTag.unpack_from(self._map, self._tags + SnapshotTag.size * number)[0])
+
+    def findTag(self, tag):
+        """Return number of tag, None if it has no Documents"""
+        if isinstance(tag, unicode):
+            tag = tag.encode('utf-8')
+        low, high = 0, self.numTags
+        while low < high:
+            middle = (low + high) // 2
+            name = self.tagName(middle)
+            if name < tag:
+                low = middle + 1
+            elif name > tag:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def postings(self, number):
+        """Return array of the Document numbers of tag number"""
+        name, start, count = SnapshotTag.unpack_from(self._map, self._tags + SnapshotTag.size * number)
+        return self.uint32s(self._postings, start, count)
+
+
+class SnapshotDocuments(object):
+    """Read only sequence of a TreeSnapshot's Documents"""
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self):
+        return self._snapshot.numDocuments
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += len(self)
+        return self._snapshot.document(number)
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self._snapshot.document(number)
+
+
+class SnapshotTagIndex(TagIndex):
+    """Read only dict-like view of a TreeSnapshot's tag names to its Documents"""
+    def __getitem__(self, tag):
+        number = self._tree.findTag(tag)
+        if number is None:
+            raise KeyError(tag)
+        return Postings(self._tree.documents, self._tree.postings(number))
+
+    def __contains__(self, tag):
+        return self._tree.findTag(tag) is not None
+
+    def __iter__(self):
+        for number in range(self._tree.numTags):
+            yield self._tree.tagName(number)
+
+    def __len__(self):
+        return self._tree.numTags
+
+
+class RelatedIndex(object):
+    """
+    Inverted index of tag names to integer Document ids.
+    Related Documents are found by accumulating shared tag counts in one pass
+    over the postings of a Document's tags and picking the best with a heap.
+    """
+    def __init__(self, documents, ignoreTags=()):
+        self.documents = list(documents)
+        self.ignoreTags = set(ignoreTags)
+        self.ids = dict((doc, docId) for docId, doc in enumerate(self.documents))
+        self.postings = {} # dict of tag names to Document ids
+        for docId, doc in enumerate(self.documents):
+            for tag in doc.tags:
+                self.postings.setdefault(tag, array('I')).append(docId)
+        # rank of each Document newest to oldest, ties keep Document order
+        self.dateRank = [0] * len(self.documents)
+        byDate = sorted(range(len(self.documents)),
+                        key=lambda docId: self.documents[docId].date,
+                        reverse=True)
+        for rank, docId in enumerate(byDate):
+            self.dateRank[docId] = rank
+
+    def sharedCounts(self, doc):
+        """Return dict of Document ids to number of tags shared with doc"""
+        counts = {}
+        get = counts.get
+        ignored = []
+        for tag in doc.tags:
+            if tag in self.ignoreTags:
+                ignored.append(tag)
+                continue
+            for docId in self.postings.get(tag, ()):
+                counts[docId] = get(docId, 0) + 1
+        counts.pop(self.ids.get(doc), None)
+        if ignored:
+            for docId in counts:
+                otherTags = self.documents[docId].tags
+                counts[docId] += len([tag for tag in ignored if tag in otherTags])
+        return counts
+
+    def scoreCandidates(self, doc, docIds):
+        """Return dict of each of docIds sharing tags with doc to the number shared"""
+        tags = set(doc.tags)
+        counts = {}
+        documents = self.documents
+        for docId in docIds:
+            count = len(tags.intersection(documents[docId].tags))
+            if count:
+                counts[docId] = count
+        counts.pop(self.ids.get(doc), None)
+        return counts
+
+    def related(self, doc, limit=6):
+        """Return list of Documents related to doc, best first"""
+        return self.best(self.sharedCounts(doc), limit=limit)
+
+    def best(self, scores, limit=6):
+        """Return list of the (at most limit) Documents with the highest scores, newest first on ties"""
+        dateRank = self.dateRank
+        key = lambda docId: (-scores[docId], dateRank[docId])
+        if limit is None:
+            best = sorted(scores, key=key)
+        else:
+            best = heapq.nsmallest(limit, scores, key=key)
+        return [self.documents[docId] for docId in best]
+
+
+class SimilarityIndex(RelatedIndex):
+    """
+    Related Documents scored by tag weights instead of raw shared tag counts
+    so tags on most Documents count for little:
+      'idf'     - sum of the inverse document frequency, log(N / df), of the
+                  shared tags
+      'cosine'  - cosine of the Documents' tag vectors weighted by idf
+      'jaccard' - shared tags / tags on either Document
+    Tags in ignoreTags are left out altogether.
+    With SciPy the scores of batchSize Documents at a time are the product of
+    sparse Document x tag matrices and the best of each are picked by
+    partitioning, otherwise the postings are walked per Document.
+    """
+    scorings = ('idf', 'cosine', 'jaccard')
+
+    def __init__(self, documents, scoring='idf', ignoreTags=(), batchSize=256):
+        if scoring not in self.scorings:
+            raise ValueError("Unknown scoring: %r" % (scoring,))
+        RelatedIndex.__init__(self, documents, ignoreTags=ignoreTags)
+        self.scoring = scoring
+        self.batchSize = batchSize
+        for tag in self.ignoreTags:
+            self.postings.pop(tag, None)
+        numDocuments = len(self.documents)
+        self.weights = {} # dict of tag names to weight
+        for tag, docIds in self.postings.items():
+            if scoring == 'jaccard':
+                self.weights[tag] = 1.0
+            else:
+                self.weights[tag] = math.log(numDocuments / float(len(docIds)))
+        # weighted length of each Document's tags
+        self.lengths = [self._length(doc.tags) for doc in self.documents]
+        self._matrix = None
+
+    def _length(self, tags):
+        """Return weighted length of tags"""
+        weights = [self.weights.get(tag, 0.0) for tag in tags]
+        if self.scoring == 'cosine':
+            return math.sqrt(sum(weight * weight for weight in weights))
+        return sum(weights)
+
+    def _score(self, shared, length, otherLength):
+        """Return score of Documents of length and otherLength from the sum of their shared tag weights"""
+        if self.scoring == 'idf':
+            return shared
+        if self.scoring == 'cosine':
+            return shared / (length * otherLength)
+        return shared / (length + otherLength - shared)
+
+    def scores(self, doc):
+        """Return dict of Document ids to score with doc, leaving out scores of 0"""
+        shared = {}
+        get = shared.get
+        for tag in doc.tags:
+            weight = self.weights.get(tag)
+            if not weight:
+                continue
+            if self.scoring == 'cosine':
+                weight *= weight
+            for otherId in self.postings[tag]:
+                shared[otherId] = get(otherId, 0.0) + weight
+        shared.pop(self.ids.get(doc), None)
+        return self._scores(doc, shared)
+
+    def _scores(self, doc, shared):
+        docId = self.ids.get(doc)
+        length = self.lengths[docId] if docId is not None else self._length(doc.tags)
+        lengths = self.lengths
+        # rounded so the SciPy and Python sums break ties the same way
+        return dict((otherId, round(self._score(weight, length, lengths[otherId]), 9))
+                    for otherId, weight in shared.items()
+                    if weight > 0)
+
+    def scoreCandidates(self, doc, docIds):
+        """Return dict of each of docIds to score with doc, leaving out scores of 0"""
+        tags = set(doc.tags)
+        weights = dict((tag, self.weights.get(tag, 0.0) ** (2 if self.scoring == 'cosine' else 1)) for tag in tags)
+        shared = {}
+        documents = self.documents
+        for docId in docIds:
+            shared[docId] = sum([weights[tag] for tag in tags.intersection(documents[docId].tags)])
+        shared.pop(self.ids.get(doc), None)
+        return self._scores(doc, shared)
+
+    def related(self, doc, limit=6):
+        """Return list of Documents related to doc, best first"""
+        return self.best(self.scores(doc), limit=limit)
+
+    def relatedAll(self, documents=None, limit=6):
+        """Return list of the related list of each of documents (default all)"""
+        if documents is None:
+            documents = self.documents
+        if scipy is None or not self.postings or any(doc not in self.ids for doc in documents):
+            return [self.related(doc, limit=limit) for doc in documents]
+        docIds = numpy.array([self.ids[doc] for doc in documents], dtype=numpy.int64)
+        out = []
+        for start in range(0, len(docIds), self.batchSize):
+            out.extend(self._relatedBatch(docIds[start:start + self.batchSize], limit))
         return out
 
-    def updateRelated(self, limit=6, ignoreTags=[]):
-        for doc in self.documents:
-            candidates = set()
-            # only look at docs (besides the current one) with at least one of our tags
-            for tag in filter(lambda x: x not in ignoreTags, doc.tags):
-                candidates.update(filter(lambda x: x != doc, self.tags[tag]))
-            doc.related = sorted(sorted(candidates, key=attrgetter('date'), reverse=True), key=lambda x: len(doc.tags.intersection(x.tags)), reverse=True)[:limit]
+    def _matrices(self):
+        """Return the left and right sparse Document x tag matrices whose product is the shared tag weights"""
+        if self._matrix is None:
+            rows, cols, weights = [], [], []
+            for tagId, (tag, docIds) in enumerate(self.postings.items()):
+                rows.append(numpy.frombuffer(docIds, dtype=numpy.dtype(docIds.typecode)))
+                cols.append(numpy.repeat(tagId, len(docIds)))
+                weights.append(numpy.repeat(self.weights[tag], len(docIds)))
+            shape = (len(self.documents), len(self.postings))
+            rows, cols, weights = numpy.concatenate(rows), numpy.concatenate(cols), numpy.concatenate(weights)
+            ones = numpy.ones(len(rows))
+            if self.scoring == 'idf':
+                left = scipy.sparse.csr_matrix((ones, (rows, cols)), shape=shape)
+                right = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=shape)
+            else:
+                left = right = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=shape)
+            self._matrix = left, right.T.tocsr()
+        return self._matrix
+
+    def _relatedBatch(self, docIds, limit):
+        left, right = self._matrices()
+        shared = (left[docIds] * right).tocsr()
+        return self.bestPairs(docIds, shared.indptr, shared.indices, shared.data, limit)
+
+    def bestPairs(self, docIds, indptr, others, weights, limit=6):
+        """
+        Return list of the related list of each of docIds from the sum of the
+        shared tag weights of each of its candidates, with the candidates of
+        docIds[i] in others[indptr[i]:indptr[i + 1]] (as in a CSR matrix).
+        """
+        rows = numpy.repeat(numpy.arange(len(docIds)), numpy.diff(indptr))
+        lengths = numpy.array(self.lengths)
+        if self.scoring in ('cosine', 'jaccard'):
+            if self.scoring == 'cosine':
+                divisors = lengths[docIds[rows]] * lengths[others]
+            else:
+                divisors = lengths[docIds[rows]] + lengths[others] - weights
+            # Documents whose only tags are on every Document have no length
+            scored = divisors > 0
+            weights = numpy.where(scored, weights, 0.0) / numpy.where(scored, divisors, 1.0)
+        # one integer per candidate ordering it by score then date, unique
+        # within a row since no two Documents have the same date rank
+        numDocuments = len(self.documents)
+        scores = numpy.rint(numpy.round(weights, 9) * 1e9).astype(numpy.int64)
+        keys = scores * numDocuments + (numDocuments - 1 - numpy.array(self.dateRank)[others])
+        keys[(others == docIds[rows]) | (scores <= 0)] = -1
+        out = []
+        documents = self.documents
+        for start, end in zip(indptr[:-1].tolist(), indptr[1:].tolist()):
+            rowKeys = -keys[start:end]
+            if limit is not None and limit < end - start:
+                best = numpy.argpartition(rowKeys, limit)[:limit]
+                best = best[numpy.argsort(rowKeys[best])]
+            else:
+                best = numpy.argsort(rowKeys)
+            best = best[rowKeys[best] < 0]
+            out.append([documents[otherId] for otherId in others[start:end][best].tolist()])
+        return out
+
+
+class MinHashIndex(object):
+    """
+    Approximate related Documents for very large archives. Each Document's
+    tags (less index.ignoreTags) get a MinHash signature of numHashes values
+    which is cut into bands of bandSize values; Documents with the same band
+    are candidates and only candidates are scored exactly by index (a
+    RelatedIndex or SimilarityIndex). Documents whose tag sets have Jaccard
+    similarity s become candidates with probability
+    1 - (1 - s**bandSize)**(numHashes / bandSize).
+    """
+    prime = (1 << 61) - 1
+
+    def __init__(self, index, numHashes=64, bandSize=3, seed=0):
+        self.index = index
+        self.numHashes = numHashes
+        self.bandSize = bandSize
+        rng = random.Random(seed)
+        self.hashes = [(rng.randrange(1, self.prime), rng.randrange(self.prime)) for i in range(numHashes)]
+        self._tagHashes = {} # dict of tag names to their hash values
+        self.bands = [{} for i in range(0, numHashes, bandSize)] # dicts of band values to Document ids
+        for docId, doc in enumerate(index.documents):
+            for band, key in enumerate(self.bandKeys(doc)):
+                self.bands[band].setdefault(key, array('I')).append(docId)
+
+    def signature(self, tags):
+        """Return the MinHash signature of tags, None if there are none to hash"""
+        hashes = []
+        for tag in tags:
+            if tag in self.index.ignoreTags:
+                continue
+            values = self._tagHashes.get(tag)
+            if values is None:
+                x = zlib.crc32(tag.encode('utf-8') if isinstance(tag, unicode) else tag) & 0xffffffff
+                values = self._tagHashes[tag] = [(a * x + b) % self.prime for a, b in self.hashes]
+            hashes.append(values)
+        if not hashes:
+            return None
+        return map(min, *hashes) if len(hashes) > 1 else hashes[0]
+
+    def bandKeys(self, doc):
+        """Return list of doc's band values"""
+        signature = self.signature(doc.tags)
+        if signature is None:
+            return []
+        return [tuple(signature[start:start + self.bandSize])
+                for start in range(0, self.numHashes, self.bandSize)]
+
+    def candidates(self, doc):
+        """Return set of ids of the Documents sharing a band with doc"""
+        candidates = set()
+        for band, key in enumerate(self.bandKeys(doc)):
+            candidates.update(self.bands[band].get(key, ()))
+        candidates.discard(self.index.ids.get(doc))
+        return candidates
+
+    def _candidateArray(self, doc):
+        """Return sorted NumPy array of the candidates of doc (which may include doc)"""
+        buckets = [self.bands[band].get(key) for band, key in enumerate(self.bandKeys(doc))]
+        buckets = [numpy.frombuffer(bucket, dtype=numpy.dtype(bucket.typecode)) for bucket in buckets if bucket]
+        if not buckets:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(buckets))
+
+    def related(self, doc, limit=6):
+        """Return list of candidate Documents related to doc, best first"""
+        return self.index.best(self.index.scoreCandidates(doc, self.candidates(doc)), limit=limit)
+
+    def relatedAll(self, documents=None, limit=6):
+        """
+        Return list of the related list of each of documents (default all).
+        With SciPy and a SimilarityIndex the candidates of a batch of
+        Documents are scored at once from the rows of its sparse matrices.
+        """
+        index = self.index
+        if documents is None:
+            documents = index.documents
+        if (scipy is None or not isinstance(index, SimilarityIndex) or not index.postings
+            or any(doc not in index.ids for doc in documents)):
+            return [self.related(doc, limit=limit) for doc in documents]
+        left, right = index._matrices()
+        right = right.T.tocsr()
+        out = []
+        for start in range(0, len(documents), index.batchSize):
+            batch = documents[start:start + index.batchSize]
+            docIds = numpy.array([index.ids[doc] for doc in batch], dtype=numpy.int64)
+            candidates = [self._candidateArray(doc) for doc in batch]
+            indptr = numpy.cumsum([0] + [len(others) for others in candidates])
+            others = numpy.concatenate(candidates).astype(numpy.int64)
+            rows = numpy.repeat(docIds, numpy.diff(indptr))
+            weights = numpy.asarray(left[rows].multiply(right[others]).sum(axis=1)).ravel()
+            out.extend(index.bestPairs(docIds, indptr, others, weights, limit))
+        return out
+
+
+class DocumentParser(object):
+    """
+    Extracts the title, date, tags and excerpt of a document using patterns
+    compiled once. parseHead reads the head a line at a time, scanText finds
+    the tags and excerpt in a body with one scan per pattern and scanLines
+    finds both in the same pass over a body's lines without keeping them.
+    """
+    datePattern = re.compile(r'^meta-creation_date:\s*(.*?)$')
+    dateFormats = ("%m/%d/%Y %H:%M", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y")
+    # the usual spellings of dateFormats, converted without strptime
+    quickDatePattern = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})(?: (\d{1,2}):(\d{1,2})(?::(\d{1,2}))?)?$')
+    tagsPattern = re.compile(r'^Tags:')
+    # tags are of the form [[tagname words used in link on page]]
+    bodyTagPattern = re.compile(r'(\[\[([\w-]+)[^[]*?\]\])+', flags=re.MULTILINE)
+    excerptPattern = re.compile(r'<p>(.*?)</p>?', flags=re.IGNORECASE|re.MULTILINE|re.DOTALL)
+
+    def parseHead(self, fp):
+        """Return title, date and explicit tags of the head read from fp"""
+        title = fp.readline().strip()
+        line = fp.readline().strip()
+        date = None
+        tags = ()
+        while line:
+            if not date:
+                date = self.extractDate(line)
+            elif not tags:
+                tags = self.extractExplicitTags(line)
+            line = fp.readline().strip()
+        return title, date, tags
+
+    def skipHead(self, fp):
+        fp.readline() # title
+        while fp.readline().strip():
+            pass
+
+    def scanText(self, body):
+        """Return tags and excerpt found in body"""
+        return self.extractTagsFromBody(body), self.extractExcerpt(body)
+
+    def scanLines(self, lines):
+        """Return the same tags and excerpt as scanText in one pass over lines"""
+        bodyTags = []
+        excerpt = None
+        head = '' # body from the first <p> while looking for the excerpt
+        pending = '' # body since the last text that can't be part of a tag
+        for line in lines:
+            if excerpt is None:
+                if head:
+                    added = line
+                else:
+                    start = line.lower().find('<p>')
+                    added = start >= 0 and line[start:] or ''
+                head += added
+                if '</p' in added.lower():
+                    excerpt = self.extractExcerpt(head)
+            pending += line
+            # a line can end a chunk if every [[ in it is followed by ]]
+            lastOpen = pending.rfind('[[')
+            if lastOpen < 0 or lastOpen < pending.rfind(']]'):
+                bodyTags.extend(self.extractTagsFromBody(pending))
+                pending = ''
+        if pending:
+            bodyTags.extend(self.extractTagsFromBody(pending))
+        if excerpt is None:
+            excerpt = self.extractExcerpt(head)
+        return tuple(bodyTags), excerpt
+
+    def extractExplicitTags(self, line):
+        tags = ()
+        match = self.tagsPattern.match(line)
+        if match:
+            tags = tuple([x.strip() for x in line[match.end():].split(",")])
+        return tags
+
+    def extractDate(self, line):
+        match = self.datePattern.search(line)
+        if match:
+            text = match.group(1).strip()
+            date = self._quickDate(text)
+            if date:
+                return date
+            for format in self.dateFormats:
+                try:
+                    return datetime.strptime(text, format)
+                except ValueError:
+                    pass
+        raise Exception("Unexpected date format: " + line)
+
+    def _quickDate(self, text):
+        if self.dateFormats != DocumentParser.dateFormats:
+            return None
+        match = self.quickDatePattern.match(text)
+        if match:
+            month, day, year, hour, minute, second = [int(x) for x in match.groups('0')]
+            try:
+                return datetime(year, month, day, hour, minute, second)
+            except ValueError:
+                pass
+        return None
+
+    def extractExcerpt(self, lines):
+        match = self.excerptPattern.search(lines)
+        return match and match.group(1) or ''
+
+    def extractTagsFromBody(self, lines):
+        # matches can only start at [[ so jump between them rather than
+        # letting the pattern try every position
+        tags = []
+        find = lines.find
+        match = self.bodyTagPattern.match
+        start = find('[[')
+        while start >= 0:
+            tag = match(lines, start)
+            if tag:
+                tags.append(tag.group(2))
+                start = find('[[', tag.end())
+            else:
+                start = find('[[', start + 1)
+        return tuple(tags)
+
 
 class Document(object):
     """Represent interesting tagged information about a single document/blog post"""
+    __slots__ = ('tags', 'excerpt', 'title', 'date', 'url', 'file', '_body', 'related', 'version')
+    parser = DocumentParser()
 
     def __init__(self,
                  url='',
@@ -68,7 +1268,8 @@ class Document(object):
                  tags=None,
                  file=None,
                  related=None,
-                 body=''):
+                 body='',
+                 lazy=False):
         self.tags = tags and set(tags) or set()
         self.excerpt = excerpt
         self.title = title
@@ -76,36 +1277,99 @@ class Document(object):
         self.url = url
         self.file = file
         self.body = body
-        self.related = related or set()
+        self.related = related or []
+        self.version = 0 # changed whenever formatted output could change
         if file:
             self.file = file
-            self.load(file)
+            self.load(file, lazy=lazy)
 
     def __repr__(self):
         return " ".join((self.title, self.url))
 
-    def load(self, fileName):
-        fp = cStringIO.StringIO(open(fileName).read())
+    @classmethod
+    def fromRecord(cls, record, file=None, url=''):
+        """
+        Construct from a record() without parsing file.
+        The body is read from file only when needed.
+        cls.__init__ isn't called so subclasses with their own arguments work.
+        """
+        doc = cls.__new__(cls)
+        doc.tags = set(record['tags'] or ())
+        doc.excerpt = record['excerpt']
+        doc.title = record['title']
+        doc.date = record['date'] or datetime.now()
+        doc.url = url
+        doc.file = file
+        doc._body = None
+        doc.related = []
+        doc.version = 0
+        return doc
+
+    def record(self):
+        """Return dict of the information parsed from this Document's file"""
+        return {'title': self.title,
+                'date': self.date,
+                'tags': tuple(self.tags),
+                'excerpt': self.excerpt}
+
+    @property
+    def body(self):
+        if self._body is None and self.file:
+            return self._readBody(self.file)
+        return self._body or ''
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+
+    def load(self, fileName, lazy=False):
+        """
+        Parse fileName. If lazy the file is read a line at a time and
+        the body isn't kept: it is read again from self.file when needed.
+        """
         # each element of path are also tags (except root and filename)
         self.tags = set(fileName.split(os.path.sep)[1:-1])
         # print fileName, self.tags
-        self._parseLines(fp)
-        fp.close()
+        with open(fileName) as fp:
+            if lazy:
+                self._parseHead(fp)
+                self._scanBody(fp)
+                self._body = None
+            else:
+                self._parseLines(fp)
+            INSTRUMENTS.count('filesRead')
+            INSTRUMENTS.count('bytesRead', os.fstat(fp.fileno()).st_size)
 
     def parse(self, text):
         fp = cStringIO.StringIO(text)
         self._parseLines(fp)
 
-    def write(self, fileName, formattedTags=None, formattedRelated=None):
-        """Rewrite with extracted tags to specified file overwriting it if it exists"""
-        with open(fileName, "w") as fp:
-            self._write_head(fp, formattedTags, formattedRelated)
-            self._write_body(fp)
+    def write(self, fileName, formattedTags=None, formattedRelated=None, skipUnchanged=False):
+        """
+        Rewrite with extracted tags to specified file overwriting it if it exists.
+        The file is replaced atomically (see atomicWrite).
+        With skipUnchanged the file isn't touched if it already has this content.
+        Return True if the file was written.
+        """
+        with INSTRUMENTS.stage('Document.write'):
+            # render first: the body may still have to be read from fileName
+            content = self.render(formattedTags, formattedRelated)
+            if skipUnchanged:
+                return writeIfChanged(fileName, content)
+            atomicWrite(fileName, content)
+            return True
+
+    def render(self, formattedTags=None, formattedRelated=None):
+        """Return the content write would write"""
+        out = cStringIO.StringIO()
+        self._write_head(out, formattedTags, formattedRelated)
+        self._write_body(out)
+        return out.getvalue()
 
     def _write_head(self, fp, formattedTags, formattedRelated):
         fp.write(self.title+"\n")
         fp.write("meta-creation_date: %s\n" % self.date.strftime("%m/%d/%Y %H:%M"))
-        fp.write("Tags: %s\n" % ", ".join(self.tags))
+        fp.write("Tags: %s\n" % ", ".join(sortedTags(self.tags)))
         if formattedTags:
             fp.write("meta-tags: %s\n" % formattedTags)
         if formattedRelated:
@@ -119,99 +1383,313 @@ class Document(object):
         self._parseHead(fp)
         self._parseBody(fp)
 
+    def _readBody(self, fileName):
+        """Return the body of fileName skipping its head"""
+        with open(fileName) as fp:
+            self.parser.skipHead(fp)
+            return fp.read()
+
     def _parseHead(self, fp):
         """Only extract title, date, and tags from header skip the rest."""
-        self.title = fp.readline().strip()
-        line = fp.readline().strip()
-        date = tags = None
-        while line:
-            if not date:
-                date = self._extractDate(line)
-                if date:
-                    self.date = date
-            elif not tags:
-                tags = self._extractExplicitTags(line)
-                if tags:
-                    self.tags.update(tags)
-            line = fp.readline().strip()
+        self.title, date, tags = self.parser.parseHead(fp)
+        if date:
+            self.date = date
+        if tags:
+            self.tags.update(tags)
 
     def _parseBody(self, fp):
-        self.body = "".join(fp.readlines())
-        bodyTags = self._extractTagsFromBody(self.body)
+        self.body = fp.read()
+        bodyTags, excerpt = self.parser.scanText(self.body)
+        self._updateFromBody(bodyTags, excerpt)
+
+    def _scanBody(self, fp):
+        """
+        Extract the same tags and excerpt as _parseBody from the rest of fp
+        a line at a time without keeping the body.
+        """
+        bodyTags, excerpt = self.parser.scanLines(fp)
+        self._updateFromBody(bodyTags, excerpt)
+
+    def _updateFromBody(self, bodyTags, excerpt):
         if bodyTags:
             self.tags.update(bodyTags)
-
-        excerpt = self._extractExcerpt(self.body)
         if excerpt:
             self.excerpt = excerpt
 
     def _extractExplicitTags(self, line):
-        tags = ()
-        match = re.match('^Tags:', line)
-        if match:
-            tags = tuple([x.strip() for x in line[match.end():].split(",")])
-        return tags
+        return self.parser.extractExplicitTags(line)
 
     def _extractDate(self, line):
-        match = re.search(r'^meta-creation_date:\s*(.*?)$', line)
-        if match:
-            for format in ("%m/%d/%Y %H:%M", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y"):
-                try:
-                    return datetime.strptime(match.groups(1)[0].strip(), format)
-                except ValueError:
-                    pass
-        raise Exception("Unexpected date format: " + line)
+        return self.parser.extractDate(line)
 
     def _extractExcerpt(self, lines):
-        match = re.search(r'<p>(.*?)</p>?', lines, flags=re.IGNORECASE|re.MULTILINE|re.DOTALL)
-        return match and match.groups(1)[0] or ''
+        return self.parser.extractExcerpt(lines)
 
     def _extractTagsFromBody(self, lines):
         """tags are of the form [[tagname words used in link on page]]"""
-        reg = re.compile(r'(\[\[([\w-]+)[^[]*?\]\])+', flags=re.MULTILINE)
-        return tuple([x.group(2) for x in re.finditer(reg, lines)])
+        return self.parser.extractTagsFromBody(lines)
 
 
+class NullInstruments(object):
+    """Instruments that record nothing, the default (see setInstruments)"""
+    def stage(self, name):
+        return _NO_STAGE
 
-def buildDocumentTree(directoryRoot=None,
+    def count(self, name, amount=1):
+        pass
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+
+class Instruments(NullInstruments):
+    """
+    Records the wall time of each stage of a build and counters (files,
+    bytes read and written, cache hits...) reported by buildDocumentTree,
+    Document.load, DocumentTree.updateRelated, generateTagResourcesHTML and
+    the writing functions once installed with setInstruments.
+    With profile each outermost stage runs under cProfile and the profile
+    of the slowest is kept in profileStats.
+    """
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.stages = OrderedDict() # dict of stage names to [seconds, calls]
+        self.counters = OrderedDict() # dict of counter names to totals
+        self.profileStage = None # name of the stage profileStats is of
+        self.profileSeconds = 0.0
+        self.profileStats = None
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing the code within as stage name"""
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+        profiler = None
+        if self.profile and depth == 0:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            yield self
+        finally:
+            seconds = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+            self._depth.value = depth
+            with self._lock:
+                totals = self.stages.setdefault(name, [0.0, 0])
+                totals[0] += seconds
+                totals[1] += 1
+                if profiler is not None and seconds >= self.profileSeconds:
+                    self.profileStage, self.profileSeconds = name, seconds
+                    self.profileStats = pstats.Stats(profiler)
+
+    def count(self, name, amount=1):
+        """Add amount to counter name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def asDict(self):
+        """Return dict of stages (seconds and calls) and counters, e.g. to save as JSON"""
+        return {'stages': OrderedDict((name, {'seconds': seconds, 'calls': calls})
+                                      for name, (seconds, calls) in self.stages.items()),
+                'counters': OrderedDict(self.counters),
+                'profileStage': self.profileStage}
+
+    def toJSON(self):
+        return json.dumps(self.asDict(), indent=2)
+
+    def summary(self):
+        """Return a table of the stages slowest first then the counters"""
+        lines = ["%-28s %10s %8s" % ("stage", "seconds", "calls")]
+        for name, (seconds, calls) in sorted(self.stages.items(), key=lambda item: -item[1][0]):
+            lines.append("%-28s %10.3f %8d" % (name, seconds, calls))
+        if self.counters:
+            lines.append("%-28s %10s" % ("counter", "total"))
+            for name, total in self.counters.items():
+                lines.append("%-28s %10d" % (name, total))
+        return "\n".join(lines)
+
+    def printProfile(self, sort='cumulative', limit=30):
+        """Print the profile of the slowest stage, if profiled"""
+        if self.profileStats is not None:
+            print "profile of %s (%.3f seconds)" % (self.profileStage, self.profileSeconds)
+            self.profileStats.sort_stats(sort).print_stats(limit)
+
+INSTRUMENTS = NullInstruments()
+
+def setInstruments(instruments):
+    """
+    Install instruments (an Instruments, None for no instruments) for the
+    pipeline to report to. Return the instruments that were installed.
+    """
+    global INSTRUMENTS
+    previous = INSTRUMENTS
+    INSTRUMENTS = instruments or NullInstruments()
+    return previous
+
+
+EPOCH = datetime(1970, 1, 1)
+
+def dateToMicroseconds(date):
+    """Return date as an integer number of microseconds since EPOCH"""
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def dateFromMicroseconds(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)
+
+
+class ParseCache(object):
+    """
+    On disk (SQLite) cache of the Document.record() parsed from each file
+    keyed on path, modification time and size so unchanged files needn't be
+    parsed again. With checkHash a hash of the file's content must match too.
+    """
+    def __init__(self, fileName, checkHash=False):
+        self.fileName = fileName
+        self.checkHash = checkHash
+        self.hits = self.misses = 0
+        self._db = sqlite3.connect(fileName)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS records ("
+                         "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, "
+                         "title TEXT, date INTEGER, tags TEXT, excerpt TEXT)")
+
+    def get(self, path, stat=None):
+        """Return the record for path or None if it isn't cached or the file changed"""
+        stat = stat or os.stat(path)
+        row = self._db.execute("SELECT mtime, size, hash, title, date, tags, excerpt "
+                               "FROM records WHERE path = ?", (path,)).fetchone()
+        if (row is None or row[0] != stat.st_mtime or row[1] != stat.st_size or
+            (self.checkHash and row[2] != self._hash(path))):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {'title': row[3],
+                'date': dateFromMicroseconds(row[4]),
+                'tags': tuple(row[5].split("\n")) if row[5] is not None else (),
+                'excerpt': row[6]}
+
+    def put(self, path, record, stat=None):
+        """Store the record parsed from path"""
+        stat = stat or os.stat(path)
+        self._db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (path, stat.st_mtime, stat.st_size,
+                          self.checkHash and self._hash(path) or None,
+                          record['title'],
+                          dateToMicroseconds(record['date']),
+                          "\n".join(record['tags']) if record['tags'] else None,
+                          record['excerpt']))
+
+    def prune(self, paths, directoryRoot=None):
+        """Forget every path not in paths, only those below directoryRoot if given"""
+        paths = set(paths)
+        prefix = os.path.join(directoryRoot, "") if directoryRoot is not None else ""
+        stale = [(path,) for (path,) in self._db.execute("SELECT path FROM records")
+                 if path not in paths and path.startswith(prefix)]
+        self._db.executemany("DELETE FROM records WHERE path = ?", stale)
+
+    def forget(self, paths):
+        """Forget each of paths"""
+        self._db.executemany("DELETE FROM records WHERE path = ?", [(path,) for path in paths])
+
+    def sync(self):
+        self._db.commit()
+
+    def close(self):
+        self.sync()
+        self._db.close()
+
+    def _hash(self, path):
+        with open(path, "rb") as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+
+
+def findDocumentFiles(directoryRoot=None,
                       findSuffix=".txt",
-                      suffix="html",
-                      baseURL="/",
-                      docClass=Document,
                       dirBlackList=[]):
     """
-    Helper/example of populating DocumentTree
-    For my needs:
-        When using directoryRoot and baseURL run from a relative directory
-        so each Document.url is set according to relative directory from the
-        directoryRoot.
+    Return sorted list of paths of files below directoryRoot ending with
+    findSuffix skipping directories starting with any in dirBlackList.
+    """
+    return [path for path, fileStat in scanDocumentFiles(directoryRoot, findSuffix, dirBlackList)]
 
-        If suffix is supplied any suffix on discovered file will be replaced
-        by the suffix keyword.
+def scanDocumentFiles(directoryRoot=None,
+                      findSuffix=".txt",
+                      dirBlackList=[],
+                      withStats=False):
     """
-    tree = DocumentTree()
-    for root, subFolders, files in os.walk(directoryRoot):
-        listed = False
-        for folder in dirBlackList:
-            if root.startswith(folder):
-                listed = True
-                break
-        if listed:
+    Return sorted list of (path, stat) of files below directoryRoot ending
+    with findSuffix (a string or tuple of them). Directories starting with
+    any in dirBlackList are not descended into at all. With withStats stat
+    is the file's os.stat result, from the directory entry where scandir
+    (os.scandir or the scandir backport) already has it, otherwise None.
+    Symbolic links to directories aren't followed, as with os.walk.
+    """
+    if not isinstance(findSuffix, tuple):
+        findSuffix = (findSuffix,)
+    dirBlackList = tuple(dirBlackList)
+    found = []
+    pending = [directoryRoot]
+    while pending:
+        root = pending.pop()
+        if dirBlackList and root.startswith(dirBlackList):
             continue
-        for filename in files:
-            if not filename.endswith(findSuffix):
-                continue
-            filePath = os.path.join(root, filename)
-            url = urlparse.urljoin(baseURL, filePath)
-            if suffix:
-                url = url.split(".")[0] + "." + suffix
-            # print "filePath:", filePath
-            doc = docClass(file=filePath,
-                           url=url)
-            modifyTags(doc)
-            tree.add(doc)
-    return tree
+        try:
+            entries = _scanDirectory(root)
+        except OSError:
+            continue
+        for name, isDir, isLink, getStat in entries:
+            path = os.path.join(root, name)
+            if isDir:
+                if not isLink:
+                    pending.append(path)
+            elif name.endswith(findSuffix):
+                found.append((path, getStat() if withStats else None))
+    found.sort()
+    return found
 
+def _scanDirectory(root):
+    """Return list of (name, isDir, isLink, stat function) of root's entries"""
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(), entry.is_symlink(), entry.stat) for entry in scandir(root)]
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            linkStat = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISLNK(linkStat.st_mode):
+            entries.append((name, os.path.isdir(path), True, functools.partial(os.stat, path)))
+        else:
+            # stat of anything else is its lstat
+            entries.append((name, stat.S_ISDIR(linkStat.st_mode), False, lambda linkStat=linkStat: linkStat))
+    return entries
+
+def _parseRecord(args):
+    """Parse a file in a worker process returning its Document.record()"""
+    docClass, filePath, lazy = args
+    return _parseDocument(docClass, filePath, lazy=lazy).record()
+
+def _parseDocument(docClass, filePath, url='', lazy=False):
+    """
+    Return docClass parsed from filePath, passing lazy only if it is asked
+    for so Document classes without it still work.
+    """
+    if lazy:
+        return docClass(file=filePath, url=url, lazy=True)
+    return docClass(file=filePath, url=url)
 
 IGNORE_TAGS = set(['static', 'Blosxom', 'RSS', 'ToDo',])
 MAP_TAGS = {'akc' : 'AKC',
@@ -230,12 +1708,481 @@ def modifyTags(doc, ignores=IGNORE_TAGS, replacements=MAP_TAGS):
     """
     Modify supplied Document by removing tags to be ignored and replacing tags with others.
     """
-    doc.tags = doc.tags.difference(IGNORE_TAGS)
-    for tag in doc.tags.intersection(MAP_TAGS.keys()):
-        doc.tags.add(MAP_TAGS[tag])
+    doc.tags = set(doc.tags).difference(ignores)
+    for tag in doc.tags.intersection(replacements.keys()):
+        doc.tags.add(replacements[tag])
         doc.tags.remove(tag)
-            
-        
+
+class TagNormalizer(object):
+    """
+    Rules turning the tags Documents are written with into the tags they
+    are listed under in a DocumentTree, in order:
+      rewrites - list of (regular expression, replacement) applied with
+                 re.sub to each tag
+      caseFold - if True tags differing only in case are the same lower
+                 case tag
+      ignore   - tags removed
+      aliases  - dict of tags to the tag used instead
+    with ignore and aliases compared after rewriting and case folding.
+    Each distinct tag is worked out once and kept in a table.
+    """
+    def __init__(self, ignore=(), aliases={}, caseFold=False, rewrites=()):
+        self.caseFold = caseFold
+        self.rewrites = [(re.compile(pattern), replacement) for pattern, replacement in rewrites]
+        self.ignore = frozenset([self._fold(tag) for tag in ignore])
+        self.aliases = dict((self._fold(tag), alias) for tag, alias in aliases.items())
+        self._table = {} # dict of tags to their canonical tag, None if ignored
+
+    def _fold(self, tag):
+        return tag.lower() if self.caseFold else tag
+
+    def canonical(self, tag):
+        """Return the tag tag is listed under, None if it is ignored"""
+        try:
+            return self._table[tag]
+        except KeyError:
+            pass
+        name = tag
+        for pattern, replacement in self.rewrites:
+            name = pattern.sub(replacement, name)
+        name = self._fold(name)
+        if not name or name in self.ignore:
+            name = None
+        else:
+            name = self.aliases.get(name, name)
+        self._table[tag] = name
+        return name
+
+    def normalize(self, tags):
+        """Return set of the canonical tags of tags, tags itself if none change"""
+        table = self._table
+        normalized = set()
+        changed = False
+        for tag in tags:
+            name = table[tag] if tag in table else self.canonical(tag)
+            if name != tag:
+                changed = True
+            if name is not None:
+                normalized.add(name)
+        return normalized if changed else tags
+
+TAG_NORMALIZER = TagNormalizer(ignore=IGNORE_TAGS, aliases=MAP_TAGS)
+
+def buildDocumentTree(directoryRoot=None,
+                      findSuffix=".txt",
+                      suffix="html",
+                      baseURL="/",
+                      docClass=Document,
+                      dirBlackList=[],
+                      cache=None,
+                      workers=None,
+                      lazy=False,
+                      normalizer=TAG_NORMALIZER):
+    """
+    Helper/example of populating DocumentTree
+    For my needs:
+        When using directoryRoot and baseURL run from a relative directory
+        so each Document.url is set according to relative directory from the
+        directoryRoot.
+
+        If suffix is supplied any suffix on discovered file will be replaced
+        by the suffix keyword.
+
+        If a ParseCache is supplied files unchanged since they were cached
+        are not parsed again.
+
+        If workers is more than one files are parsed by that many processes.
+        Documents are added in path order either way so the tree is the same.
+
+        If lazy Documents don't keep their body in memory (see Document.load).
+
+        Tags are listed as normalizer (a TagNormalizer or None) makes them.
+    """
+    tree = DocumentTree(normalizer=normalizer)
+    with INSTRUMENTS.stage('scan'):
+        found = scanDocumentFiles(directoryRoot, findSuffix, dirBlackList, withStats=cache is not None)
+    paths = [filePath for filePath, fileStat in found]
+    records = {} # dict of paths to records from cache or workers
+    stats = dict(found) # dict of paths to os.stat results when caching
+    if cache is not None:
+        with INSTRUMENTS.stage('cache lookup'):
+            for filePath in paths:
+                record = cache.get(filePath, stats[filePath])
+                if record:
+                    records[filePath] = record
+        INSTRUMENTS.count('cacheHits', len(records))
+        INSTRUMENTS.count('cacheMisses', len(paths) - len(records))
+    missing = [filePath for filePath in paths if filePath not in records]
+    # no processes needed when every file was cached
+    if workers and workers > 1 and missing:
+        with INSTRUMENTS.stage('parse'):
+            pool = multiprocessing.Pool(workers)
+            try:
+                parsed = pool.map(_parseRecord,
+                                  [(docClass, filePath, lazy) for filePath in missing],
+                                  max(1, len(missing) // (workers * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        # the workers' counts stay in their processes
+        INSTRUMENTS.count('filesRead', len(missing))
+        INSTRUMENTS.count('bytesRead', sum([(stats.get(filePath) or os.stat(filePath)).st_size
+                                            for filePath in missing]))
+        for filePath, record in zip(missing, parsed):
+            records[filePath] = record
+            if cache is not None:
+                cache.put(filePath, record, stats[filePath])
+    with INSTRUMENTS.stage('parse'):
+        for filePath in paths:
+            url = documentURL(filePath, baseURL, suffix)
+            # print "filePath:", filePath
+            if filePath in records:
+                doc = docClass.fromRecord(records[filePath], file=filePath, url=url)
+            else:
+                doc = _parseDocument(docClass, filePath, url, lazy)
+                if cache is not None:
+                    cache.put(filePath, doc.record(), stats[filePath])
+            tree.add(doc)
+    INSTRUMENTS.count('documents', len(paths))
+    if cache is not None:
+        # files deleted since the last build
+        cache.prune(paths, directoryRoot)
+        cache.sync()
+    return tree
+
+def _buildShard(args):
+    """Build a DocumentTree in a worker process saving it to fileName"""
+    directoryRoot, baseURL, options, fileName = args
+    buildDocumentTree(directoryRoot, baseURL=baseURL, **options).save(fileName)
+    return fileName
+
+def buildShardedDocumentTree(roots, workers=None, **options):
+    """
+    Build a DocumentTree of each of roots, directory roots or
+    (directoryRoot, baseURL) pairs, e.g. one per blog, and return them
+    merged (see DocumentTree.merge) for a shared tag cloud and related
+    Documents across all of them. options are passed to buildDocumentTree.
+
+    If workers is more than one that many processes build the roots, each
+    saving its tree as a snapshot (see DocumentTree.save) for this process
+    to load, so the Documents have no body and a ParseCache can't be used.
+    """
+    baseURL = options.pop('baseURL', "/")
+    roots = [root if isinstance(root, tuple) else (root, baseURL) for root in roots]
+    if not workers or workers < 2:
+        return DocumentTree.merge([buildDocumentTree(directoryRoot, baseURL=rootURL, **options)
+                                   for directoryRoot, rootURL in roots])
+    if options.get('cache') is not None:
+        raise ValueError("A ParseCache can't be shared by processes building shards")
+    directory = tempfile.mkdtemp(prefix=".tagging-shards.")
+    try:
+        with INSTRUMENTS.stage('build shards'):
+            pool = multiprocessing.Pool(workers)
+            try:
+                fileNames = pool.map(_buildShard,
+                                     [(directoryRoot, rootURL, options, os.path.join(directory, "%d.snapshot" % i))
+                                      for i, (directoryRoot, rootURL) in enumerate(roots)],
+                                     1)
+            finally:
+                pool.close()
+                pool.join()
+        shards = [DocumentTree.load(fileName,
+                                    docClass=options.get('docClass'),
+                                    normalizer=options.get('normalizer', TAG_NORMALIZER))
+                  for fileName in fileNames]
+    finally:
+        shutil.rmtree(directory)
+    return DocumentTree.merge(shards)
+
+def documentURL(filePath, baseURL="/", suffix="html"):
+    """Return the URL of the Document in filePath (see buildDocumentTree)"""
+    url = urlparse.urljoin(baseURL, filePath)
+    if suffix:
+        url = url.split(".")[0] + "." + suffix
+    return url
+
+def applyChanges(tree,
+                 added=(),
+                 changed=(),
+                 removed=(),
+                 suffix="html",
+                 baseURL="/",
+                 docClass=Document,
+                 cache=None,
+                 lazy=False):
+    """
+    Bring tree up to date with files added, changed and removed since it was
+    built (e.g. as reported by Watcher), parsing only those files.
+    tree's dirty attributes record what needs regenerating (see
+    DocumentTree.clearDirty). Tags are normalized by tree's normalizer.
+    Files that can't be parsed (e.g. with a bad date) leave the Document
+    already in tree, if any, as it was.
+    Return list of (path, exception) of the files that couldn't be parsed.
+    """
+    failed = []
+    for filePath in removed:
+        previous = tree._files.get(filePath)
+        if previous is not None:
+            tree.remove(previous)
+    if cache is not None:
+        cache.forget(removed)
+    for filePath in list(added) + list(changed):
+        try:
+            doc = _parseDocument(docClass, filePath, documentURL(filePath, baseURL, suffix), lazy)
+        except (IOError, OSError):
+            # gone again since it was seen
+            continue
+        except Exception as error:
+            failed.append((filePath, error))
+            continue
+        if cache is not None:
+            cache.put(filePath, doc.record())
+        tree.update(doc)
+    if cache is not None:
+        cache.sync()
+    return failed
+
+
+class Watcher(object):
+    """
+    Watches directoryRoot for files ending with findSuffix being added,
+    changed or removed by polling every interval seconds, portably, for
+    changes to their modification time or size. A burst of changes is
+    reported once it has been quiet for debounce seconds.
+    Files this process writes should be passed to ignore() afterwards so
+    they aren't reported as changed.
+    """
+    def __init__(self, directoryRoot, findSuffix=".txt", dirBlackList=[], interval=1.0, debounce=0.5):
+        self.directoryRoot = directoryRoot
+        self.findSuffix = findSuffix
+        self.dirBlackList = dirBlackList
+        self.interval = interval
+        self.debounce = debounce
+        self.snapshot = self._scan() # dict of paths to (mtime, size)
+
+    def _scan(self):
+        return dict((filePath, (fileStat.st_mtime, fileStat.st_size))
+                    for filePath, fileStat in scanDocumentFiles(self.directoryRoot,
+                                                                self.findSuffix,
+                                                                self.dirBlackList,
+                                                                withStats=True))
+
+    def poll(self):
+        """Return sorted lists of paths added, changed and removed since the last poll"""
+        previous, self.snapshot = self.snapshot, self._scan()
+        return self._difference(previous, self.snapshot)
+
+    def _difference(self, previous, current):
+        added = sorted([filePath for filePath in current if filePath not in previous])
+        changed = sorted([filePath for filePath in current
+                          if filePath in previous and current[filePath] != previous[filePath]])
+        removed = sorted([filePath for filePath in previous if filePath not in current])
+        return added, changed, removed
+
+    def ignore(self, paths):
+        """Take paths as they are now as unchanged, e.g. after writing them"""
+        for filePath in paths:
+            try:
+                fileStat = os.stat(filePath)
+            except OSError:
+                self.snapshot.pop(filePath, None)
+                continue
+            if filePath in self.snapshot:
+                self.snapshot[filePath] = (fileStat.st_mtime, fileStat.st_size)
+
+    def wait(self, timeout=None):
+        """
+        Wait for changes, returning (added, changed, removed) as poll() once
+        a burst of them is over, or None after timeout seconds without any.
+        """
+        start = time.time()
+        before = self.snapshot
+        while not any(self.poll()):
+            if timeout is not None and time.time() - start >= timeout:
+                return None
+            before = self.snapshot
+            time.sleep(self.interval)
+        while True:
+            time.sleep(self.debounce)
+            if not any(self.poll()):
+                break
+        return self._difference(before, self.snapshot)
+
+    def changes(self):
+        """Yield each burst of changes as wait(), forever"""
+        while True:
+            change = self.wait()
+            if any(change):
+                yield change
+
+
+# Generated tag pages state when they were generated: ignore that when
+# deciding whether a page changed.
+VolatilePattern = re.compile(r'^meta-creation_date:.*$', flags=re.MULTILINE)
+
+def contentHash(content, volatile=None):
+    """Return hash of content ignoring the first match of the volatile pattern"""
+    if volatile is not None:
+        content = volatile.sub('', content, 1)
+    return hashlib.sha1(content).hexdigest()
+
+def writeIfChanged(fileName, content, volatile=None):
+    """
+    Write content to fileName unless the file's content has the same
+    contentHash. Return True if the file was written.
+    """
+    try:
+        with open(fileName, "rb") as fp:
+            existing = fp.read()
+    except IOError:
+        existing = None
+    if existing is not None and contentHash(existing, volatile) == contentHash(content, volatile):
+        INSTRUMENTS.count('filesUnchanged')
+        return False
+    atomicWrite(fileName, content)
+    return True
+
+def _createTemporary(fileName):
+    """
+    Create a new file beside fileName to be renamed to it, with the
+    permissions open() gives new files. Return its (fd, path).
+    """
+    directory, name = os.path.split(fileName)
+    while True:
+        temp = os.path.join(directory or ".", ".%s.%08x.tmp" % (name, random.getrandbits(32)))
+        try:
+            return os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0666), temp
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+def atomicWrite(fileName, content, sync=False):
+    """
+    Write content (a string or iterable of strings) to a temporary file
+    beside fileName and rename it to fileName, so fileName never has only
+    part of content even if writing fails. An existing fileName keeps its
+    permissions. With sync the data is on disk before the rename.
+    """
+    fd, temp = _createTemporary(fileName)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            if isinstance(content, basestring):
+                fp.write(content)
+            else:
+                fp.writelines(content)
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+            written = fp.tell()
+        try:
+            os.chmod(temp, stat.S_IMODE(os.stat(fileName).st_mode))
+        except OSError:
+            # new file
+            pass
+        os.rename(temp, fileName)
+    except:
+        os.unlink(temp)
+        raise
+    INSTRUMENTS.count('filesWritten')
+    INSTRUMENTS.count('bytesWritten', written)
+
+
+def sortedTags(tags):
+    """
+    Return tag names in a stable (case insensitive) order: a set's order
+    depends on how it was built so output would change from run to run.
+    """
+    return sorted(tags, key=lambda tag: (tag.lower(), tag))
+
+
+class WriteStats(object):
+    """Count of files written and skipped because they hadn't changed"""
+    def __init__(self):
+        self.written = self.skipped = 0
+
+    def add(self, written):
+        if written:
+            self.written += 1
+        else:
+            self.skipped += 1
+
+    def __repr__(self):
+        return "%d written, %d unchanged" % (self.written, self.skipped)
+
+
+class OutputWriter(object):
+    """
+    Writes files atomically (see atomicWrite) spread over a bounded pool of
+    threads, timing each file. With skipUnchanged files are only written if
+    their content changed (see writeIfChanged).
+    Call close() to wait for every write; the first error is raised there.
+    """
+    def __init__(self, workers=8, skipUnchanged=False, sync=False):
+        self.skipUnchanged = skipUnchanged
+        self.sync = sync
+        self.stats = WriteStats()
+        self.latencies = [] # (fileName, seconds) for each file
+        self._pool = workers > 1 and ThreadPool(workers) or None
+        # limit content waiting in memory for a thread
+        self._pending = threading.BoundedSemaphore(max(1, workers) * 4)
+        self._results = []
+
+    def write(self, fileName, content, volatile=None):
+        """
+        Write content (a string or iterable of strings) to fileName.
+        volatile is a pattern to ignore when comparing with the existing file.
+        """
+        if self._pool is None:
+            self._record(self._write(fileName, content, volatile))
+            return
+        if not isinstance(content, basestring):
+            content = "".join(content)
+        self._pending.acquire()
+        self._results.append(self._pool.apply_async(self._write, (fileName, content, volatile)))
+
+    def close(self):
+        """Wait for all writes, returning WriteStats"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            for result in self._results:
+                self._record(result.get())
+            self._results = []
+        return self.stats
+
+    def latencySummary(self):
+        """Return dict of count, mean, median, 95th percentile and max seconds per file"""
+        times = sorted([seconds for fileName, seconds in self.latencies])
+        if not times:
+            return {'count': 0}
+        return {'count': len(times),
+                'mean': sum(times) / len(times),
+                'median': times[len(times) // 2],
+                'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+                'max': times[-1]}
+
+    def _write(self, fileName, content, volatile):
+        try:
+            start = time.time()
+            if self.skipUnchanged:
+                if not isinstance(content, basestring):
+                    content = "".join(content)
+                written = writeIfChanged(fileName, content, volatile)
+            else:
+                atomicWrite(fileName, content, self.sync)
+                written = True
+            return written, fileName, time.time() - start
+        finally:
+            if self._pool is not None:
+                self._pending.release()
+
+    def _record(self, result):
+        written, fileName, seconds = result
+        self.stats.add(written)
+        self.latencies.append((fileName, seconds))
+
+
 # Helper functions to provide HTML output of:
 # - Documents associated with a tag
 #   I use this to generate a static HTML page for each tag. That page contains a link to each document
@@ -246,26 +2193,144 @@ def modifyTags(doc, ignores=IGNORE_TAGS, replacements=MAP_TAGS):
 # 1. override templates
 # 2. use functools.partial to wrap functions with customizations
 #
+class FragmentCache(object):
+    """
+    Least recently used cache of HTML fragments shared by documentToHTML and
+    tagsToHTML so a Document's HTML is generated once however many tag pages
+    it is on and is reused again when its source file is rewritten.
+    Document fragments are keyed on the Document and its version.
+    """
+    def __init__(self, maxSize=20000):
+        self.maxSize = maxSize
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.maxSize:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+    def reserve(self, size):
+        """Grow maxSize to at least size, e.g. to hold every fragment of a build"""
+        self.maxSize = max(self.maxSize, size)
+
+    def clear(self):
+        self._items.clear()
+
+FRAGMENT_CACHE = FragmentCache()
+
+class _Placeholders(dict):
+    """Values for a CompiledTemplate leaving placeholders without one as they are"""
+    def __init__(self, mapping, delimiter):
+        dict.__init__(self, mapping)
+        self.delimiter = delimiter
+
+    def __missing__(self, key):
+        if key.startswith("{"):
+            name = key[1:-1]
+            if name in self:
+                return self[name]
+        return self.delimiter + key
+
+class CompiledTemplate(object):
+    """
+    A string.Template compiled once into a %-format string. Calling it
+    with keyword arguments gives the same result as its safe_substitute
+    without matching the template's pattern on every call.
+    """
+    def __init__(self, template):
+        self.template = template
+        self.source = template.template
+        pieces = []
+        last = 0
+        for match in template.pattern.finditer(self.source):
+            pieces.append(self.source[last:match.start()].replace("%", "%%"))
+            last = match.end()
+            if match.group('named') is not None:
+                pieces.append("%%(%s)s" % match.group('named'))
+            elif match.group('braced') is not None:
+                pieces.append("%%({%s})s" % match.group('braced'))
+            else:
+                # escaped or invalid delimiter, both left as one delimiter
+                pieces.append(template.delimiter.replace("%", "%%"))
+        pieces.append(self.source[last:].replace("%", "%%"))
+        self.format = "".join(pieces)
+
+    def __call__(self, **mapping):
+        try:
+            return self.format % mapping
+        except KeyError:
+            return self.format % _Placeholders(mapping, self.template.delimiter)
+
+# dict of string.Template to its CompiledTemplate
+COMPILED_TEMPLATES = {}
+
+def compileTemplate(template, cache=COMPILED_TEMPLATES):
+    """
+    Return a function rendering template like its safe_substitute, compiled
+    the first time each template is used and again if its text is changed.
+    Templates that are not string.Templates, or override safe_substitute,
+    are rendered with their own safe_substitute.
+    """
+    if (not isinstance(template, string.Template) or
+        type(template).safe_substitute.im_func is not string.Template.safe_substitute.im_func):
+        return template.safe_substitute
+    compiled = cache.get(template)
+    if compiled is None or compiled.source is not template.template:
+        compiled = cache[template] = CompiledTemplate(template)
+    return compiled
+
 TagTemplate = string.Template("""<li class="tag"><a href="$url">$name</a></li>""")
 TagWrapperTemplate = string.Template("""<table border="0" class="tags-table"><tr><td class="tags-label">Tags: <i class="icon-tags"></i></td><td><ul class="tags">$tags</ul></td</tr></table>""")
+# dict of (tag name, baseURL, suffix) to URL
+TAG_URL_CACHE = {}
+
 def tagFilePath(name,
                 baseURL="/blog/tags/",
-                suffix="html"):
+                suffix="html",
+                cache=TAG_URL_CACHE):
     """
     Generate URL for resource containing all Documents having this tag name.
+    URLs are kept in cache so each is joined once.
     """
-    return urlparse.urljoin(baseURL, name+"."+suffix)
+    key = (name, baseURL, suffix)
+    url = cache.get(key)
+    if url is None:
+        url = cache[key] = urlparse.urljoin(baseURL, name+"."+suffix)
+    return url
 
 def tagsToHTML(tags,
                tagToUrl=tagFilePath,
                parentElement=TagWrapperTemplate,
-               tagTemplate=TagTemplate):
+               tagTemplate=TagTemplate,
+               cache=FRAGMENT_CACHE):
     """
     Generate HTML (fragment) for a list of tag names each linked to their own page.
     Assumes all tag page URLs are on the same path
     """
-    tags = "".join([tagTemplate.safe_substitute(name=name, url=tagToUrl(name)) for name in tags])
-    html = parentElement.safe_substitute(tags=tags)
+    if cache is not None:
+        key = (tuple(tags), tagToUrl, parentElement, tagTemplate)
+        html = cache.get(key)
+        if html is None:
+            html = cache[key] = tagsToHTML(key[0], tagToUrl, parentElement, tagTemplate, cache=None)
+        return html
+    render = compileTemplate(tagTemplate)
+    tags = "".join([render(name=name, url=tagToUrl(name)) for name in tags])
+    html = compileTemplate(parentElement)(tags=tags)
     return html
 
 DocumentTemplate = string.Template("""<article style="clear:both;"><h2><a href="$url">$title</a></h2><div class="date">$date</div><div class="body"><p>$excerpt</p><p><a class="seemore" href="$url">Read more...</a></p>$tags</div></article>""")
@@ -273,53 +2338,202 @@ DocumentTemplate = string.Template("""<article style="clear:both;"><h2><a href="
 def documentToHTML(doc,
                    dateFormat="%d %b %Y",
                    tagFormatter=tagsToHTML,
-                   documentTemplate=DocumentTemplate):
+                   documentTemplate=DocumentTemplate,
+                   cache=FRAGMENT_CACHE):
     """
     Generate HTML for Document fragment for inclusion on HTML page
     listing all Documents for a specific tag.
     """
-    html = documentTemplate.safe_substitute(title=doc.title,
-                                            url=doc.url,
-                                            date=doc.date.strftime(dateFormat),
-                                            excerpt=doc.excerpt,
-                                            tags=tagFormatter(doc.tags))
+    if cache is not None:
+        key = (doc, doc.version, dateFormat, tagFormatter, documentTemplate)
+        html = cache.get(key)
+        if html is None:
+            html = cache[key] = documentToHTML(doc, dateFormat, tagFormatter, documentTemplate, cache=None)
+        return html
+    html = compileTemplate(documentTemplate)(title=doc.title,
+                                             url=doc.url,
+                                             date=doc.date.strftime(dateFormat),
+                                             excerpt=doc.excerpt,
+                                             tags=tagFormatter(sortedTags(doc.tags)))
     return html
 
 PageTemplate = string.Template("""Articles Tagged With: '$tag'
 meta-creation_date: $date
 
-<div class="tag-docs">$docs</div>""")
+<div class="tag-docs">$docs</div>$pager""")
+
+PagerTemplate = string.Template("""<div class="pager">$newer$older</div>""")
+
+NewerTemplate = string.Template("""<a class="newer" href="$url">Newer</a>""")
+
+OlderTemplate = string.Template("""<a class="older" href="$url">Older</a>""")
+
+def tagPages(docs, pageSize=None):
+    """
+    Split a tag's Documents, newest to oldest, into pages of pageSize.
+    Return list of (number, docs) newest page first. The first page is
+    number 0 and holds the newest 1 to pageSize Documents; the rest are
+    numbered from the oldest page up, so a new Document only changes the
+    first page until it fills and its Documents move to a new page.
+    """
+    if not pageSize or len(docs) <= pageSize:
+        return [(0, docs)]
+    numArchived = (len(docs) - 1) // pageSize
+    first = len(docs) - numArchived * pageSize
+    pages = [(0, docs[:first])]
+    for number in xrange(numArchived, 0, -1):
+        start = first + (numArchived - number) * pageSize
+        pages.append((number, docs[start:start + pageSize]))
+    return pages
+
+def tagPageName(tag, number=0):
+    """
+    Name of page number of a tag relative to the tag pages, e.g. python/2.
+    """
+    return tag if not number else tag + "/" + str(number)
+
+def pagerHTML(tag,
+              numbers,
+              index,
+              tagToUrl=tagFilePath,
+              pagerTemplate=PagerTemplate,
+              newerTemplate=NewerTemplate,
+              olderTemplate=OlderTemplate):
+    """
+    Generate HTML linking page index of a tag's page numbers (as from
+    tagPages) to the pages before and after it, empty if there is only one.
+    """
+    if len(numbers) < 2:
+        return ""
+    newer = older = ""
+    if index > 0:
+        newer = compileTemplate(newerTemplate)(url=tagToUrl(tagPageName(tag, numbers[index - 1])))
+    if index < len(numbers) - 1:
+        older = compileTemplate(olderTemplate)(url=tagToUrl(tagPageName(tag, numbers[index + 1])))
+    return compileTemplate(pagerTemplate)(newer=newer, older=older)
 
 def tagResourceHTML(tag,
                     docs,
                     docFormatter=documentToHTML,
                     dateFormat="%m/%d/%Y 0:00",
-                    pageTemplate=PageTemplate):
+                    pageTemplate=PageTemplate,
+                    pageSize=None,
+                    page=0,
+                    tagToUrl=tagFilePath):
     """
     Generate HTML content for a list of
     Documents associated with the specified tag in the order provided.
+    With pageSize only the Documents of page number page (see tagPages)
+    are included, with links to the newer and older pages.
     """
-    output = pageTemplate.safe_substitute(docs="".join([documentToHTML(x) for x in docs]),
-                                          num=len(docs),
-                                          tag=tag,
-                                          date=datetime.now().strftime(dateFormat))
-    return output
+    pages = tagPages(docs, pageSize)
+    numbers = [number for number, pageDocs in pages]
+    index = numbers.index(page)
+    return "".join(iterTagResourceHTML(tag,
+                                       pages[index][1],
+                                       docFormatter=docFormatter,
+                                       dateFormat=dateFormat,
+                                       pageTemplate=pageTemplate,
+                                       pager=pagerHTML(tag, numbers, index, tagToUrl=tagToUrl)))
+
+def iterTagResourceHTML(tag,
+                        docs,
+                        docFormatter=documentToHTML,
+                        dateFormat="%m/%d/%Y 0:00",
+                        pageTemplate=PageTemplate,
+                        fragments=None,
+                        pager=""):
+    """
+    Generate the HTML of tagResourceHTML a piece at a time: the page around
+    the Documents and then each Document's HTML, so it can be written out
+    without building the whole page in memory.
+    If supplied fragments is a dict (or FragmentCache) of Documents to their
+    HTML, shared between calls so each Document is formatted only once.
+    documentToHTML does that itself with FRAGMENT_CACHE.
+    pager is the HTML linking to the tag's other pages, if any.
+    """
+    marker = "\0docs\0"
+    page = compileTemplate(pageTemplate)(docs=marker,
+                                         num=len(docs),
+                                         tag=tag,
+                                         date=datetime.now().strftime(dateFormat),
+                                         pager=pager)
+    parts = page.split(marker)
+    yield parts[0]
+    for part in parts[1:]:
+        for doc in docs:
+            if fragments is None:
+                yield docFormatter(doc)
+                continue
+            html = fragments.get(doc)
+            if html is None:
+                html = fragments[doc] = docFormatter(doc)
+            yield html
+        yield part
 
-def generateTagResourcesHTML(doctree, tags, destPath, dateFormat="%m/%d/%Y %H:%M:00", suffix=".txt"):
+def removeStaleTagPages(destPath, tag, numbers, suffix=".txt"):
+    """
+    Remove the pages of tag written to destPath by generateTagResourcesHTML
+    whose page numbers aren't in numbers, e.g. after the tag lost Documents.
+    """
+    directory = os.path.join(destPath, tag)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        number = name[:-len(suffix)] if suffix and name.endswith(suffix) else None
+        if number and number.isdigit() and int(number) not in numbers:
+            os.remove(os.path.join(directory, name))
+
+def generateTagResourcesHTML(doctree, tags, destPath, dateFormat="%m/%d/%Y %H:%M:00", suffix=".txt",
+                             skipUnchanged=False, writer=None, pageSize=None, tagToUrl=tagFilePath):
     """
     Example writing HTML files for each tag to disk
+    Each page is written atomically as it is generated.
+    With pageSize tags with more Documents are split into pages (see
+    tagPages): the newest in tag+suffix and the older in tag/number+suffix,
+    linked to each other with URLs from tagToUrl. Older pages only change
+    when Documents on them do, so with skipUnchanged a new Document
+    rewrites just the first page of its tags.
+    With skipUnchanged pages are generated in memory and only written if
+    they differ from the existing file by more than their date.
+    Pages are handed to writer if supplied (an OutputWriter, e.g. writing
+    with many threads), which then decides whether to skip unchanged pages
+    and must be closed by the caller.
+    FRAGMENT_CACHE is grown to hold a Document fragment and a tag list per
+    Document so each is only generated once however many pages it is on.
+    Return the WriteStats of the writer.
     """
     try:
         os.makedirs(destPath)
     except OSError:
         pass
-    for tag in tags:
-        docs = doctree.tags[tag]
-        # sort docs newest to oldest
-        docs = sorted(docs, key=lambda x: x.date, reverse=True)
-        html = tagResourceHTML(tag, docs, dateFormat=dateFormat)
-        with open(os.path.join(destPath, tag+suffix), "w") as f:
-            f.write(html)
+    FRAGMENT_CACHE.reserve(2 * len(doctree.documents))
+    ownWriter = writer is None
+    if ownWriter:
+        writer = OutputWriter(workers=1, skipUnchanged=skipUnchanged)
+    with INSTRUMENTS.stage('generateTagResourcesHTML'):
+        for tag in tags:
+            # docs newest to oldest
+            docs = doctree.query(tags=[tag])
+            pages = tagPages(docs, pageSize)
+            numbers = [number for number, pageDocs in pages]
+            if len(pages) > 1:
+                try:
+                    os.makedirs(os.path.join(destPath, tag))
+                except OSError:
+                    pass
+            for index, (number, pageDocs) in enumerate(pages):
+                writer.write(os.path.join(destPath, *tagPageName(tag, number).split("/"))+suffix,
+                             iterTagResourceHTML(tag, pageDocs, dateFormat=dateFormat,
+                                                 pager=pagerHTML(tag, numbers, index, tagToUrl=tagToUrl)),
+                             VolatilePattern)
+                INSTRUMENTS.count('tagPages')
+            removeStaleTagPages(destPath, tag, numbers, suffix)
+        if ownWriter:
+            writer.close()
+    return writer.stats
 
 CloudTemplate = string.Template("""<div class="tag-cloud">$tags</div>""")
 CloudTagTemplate = string.Template("""<a class="tag-$bucket" href="$url">$tag</a> """)
@@ -328,8 +2542,9 @@ def htmlCloud(cloudifyOutput,
               cloudTemplate=CloudTemplate,
               cloudTagTemplate=CloudTagTemplate):
     """Sort cloudifyOutput to suit your outputting needs."""
-    tags = "".join([cloudTagTemplate.safe_substitute(tag=tag, bucket=bucket, url=url) for tag, bucket, url in cloudifyOutput])
-    output = cloudTemplate.safe_substitute(tags=tags)
+    render = compileTemplate(cloudTagTemplate)
+    tags = "".join([render(tag=tag, bucket=bucket, url=url) for tag, bucket, url in cloudifyOutput])
+    output = compileTemplate(cloudTemplate)(tags=tags)
     return output
 
 
@@ -341,22 +2556,87 @@ if __name__ == "__main__":
     def validTags(element):
         return "_" not in element[0]
 
-    tree = buildDocumentTree(".", baseURL="/blog/", dirBlackList=['./tech', './tags'])
-    cloud = filter(validTags, tree.cloudify())
+    def writeCloud(tree):
+        with INSTRUMENTS.stage('cloud'):
+            cloud = filter(validTags, tree.cloudify())
+
+            # sort by tag name
+            html = htmlCloud(sorted(cloud, key=lambda x : x[0].lower()))
+            # put html cloud into fragment file for inclusion in other pages:
+            with open("../plugins/filedata/tagcloud", "w") as cloudFile:
+                cloudFile.write(html)
+
+    def writeDocuments(docs, writer):
+        # update each source file with the updated tags and formatted tags
+        with INSTRUMENTS.stage('write'):
+            for doc in docs:
+                writer.write(doc.file, doc.render(formattedTags=tagsToHTML(sortedTags(doc.tags)),
+                                                  formattedRelated=relatedToHTML(doc.related)))
+            writer.close()
 
-    # sort by tag name
-    html = htmlCloud(sorted(cloud, key=lambda x : x[0].lower()))
-    # put html cloud into fragment file for inclusion in other pages:
-    with open("../plugins/filedata/tagcloud", "w") as cloudFile:
-        cloudFile.write(html)
+    def rebuildChanged(tree, watcher, added, changed, removed):
+        """Regenerate only what the changed files affect"""
+        tree.clearDirty()
+        for filePath, error in applyChanges(tree, added, changed, removed, baseURL="/blog/", cache=cache, lazy=True):
+            print >> sys.stderr, "%s not updated: %s" % (filePath, error)
+        if tree.dirtyCloud:
+            writeCloud(tree)
+        writer = OutputWriter(workers=8, skipUnchanged=True)
+        tags = [tag for tag in tree.dirtyTags if tag in tree.tags]
+        generateTagResourcesHTML(tree, tags, "./tags", writer=writer, pageSize=options.page_size)
+        for tag in tree.dirtyTags.difference(tags):
+            if os.path.exists(os.path.join("./tags", tag + ".txt")):
+                os.remove(os.path.join("./tags", tag + ".txt"))
+            if os.path.isdir(os.path.join("./tags", tag)):
+                shutil.rmtree(os.path.join("./tags", tag))
+        docs = [doc for doc in tree.dirtyDocuments if doc in tree]
+        tree.updateRelated(scoring='idf', documents=docs)
+        writeDocuments(docs, writer)
+        watcher.ignore([doc.file for doc in docs])
+        print "%d added, %d changed, %d removed; files: %r" % (len(added), len(changed), len(removed), writer.stats)
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Tag the blog documents below the current directory.")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, regenerating what changed documents affect")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between checks for changes when watching")
+    parser.add_argument("--debounce", type=float, default=0.5,
+                        help="seconds without changes that end a burst of them when watching")
+    parser.add_argument("--page-size", type=int, default=None,
+                        help="documents per tag page, older documents going on further pages")
+    parser.add_argument("--stats", action="store_true", help="print the time of each stage and counters")
+    parser.add_argument("--stats-json", metavar="FILE", help="save the stage times and counters as JSON")
+    parser.add_argument("--profile", action="store_true", help="print a profile of the slowest stage")
+    options = parser.parse_args()
+    if options.stats or options.stats_json or options.profile:
+        setInstruments(Instruments(profile=options.profile))
+
+    dirBlackList = ['./tech', './tags']
+    cache = ParseCache("./.tagging-cache")
+    tree = buildDocumentTree(".", baseURL="/blog/", dirBlackList=dirBlackList, cache=cache, lazy=True)
+    writeCloud(tree)
     # generate tag files only for the tags in the cloud
     # tags = [tag for tag, bucket, url in cloud]
     tags = tree.tags
-    generateTagResourcesHTML(tree, tags, "./tags")
-
-    tree.updateRelated(ignoreTags=['journal', 'agility',])
-    # now update each source file with the updated tags and formatted tags
-    for doc in tree.documents:
-        doc.write(doc.file,
-                  formattedTags=tagsToHTML(doc.tags),
-                  formattedRelated=relatedToHTML(doc.related))
+    writer = OutputWriter(workers=8, skipUnchanged=True)
+    generateTagResourcesHTML(tree, tags, "./tags", writer=writer, pageSize=options.page_size)
+
+    tree.updateRelated(scoring='idf')
+    writeDocuments(tree.documents, writer)
+    print "files: %r, seconds per file: %r" % (writer.stats, writer.latencySummary())
+    if options.watch:
+        watcher = Watcher(".", dirBlackList=dirBlackList, interval=options.interval, debounce=options.debounce)
+        print "watching for changes, interrupt to stop"
+        try:
+            for added, changed, removed in watcher.changes():
+                rebuildChanged(tree, watcher, added, changed, removed)
+        except KeyboardInterrupt:
+            pass
+    cache.close()
+    if options.stats:
+        print INSTRUMENTS.summary()
+    if options.stats_json:
+        with open(options.stats_json, "w") as fp:
+            fp.write(INSTRUMENTS.toJSON())
+    if options.profile:
+        INSTRUMENTS.printProfile()
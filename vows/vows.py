@@ -1,10 +1,34 @@
+import functools
+import json
 import os
 from datetime import datetime
 import shutil
+import string
 import operator
+import tempfile
+import warnings
 import cStringIO
 from pyvows import Vows, expect
-from tagging import Document, DocumentTree, htmlCloud, tagResourceHTML, documentToHTML, generateTagResourcesHTML
+import tagging
+from tagging import Document, DocumentParser, DocumentTree, FragmentCache, tagsToHTML, sortedTags, htmlCloud, cloudBuckets, tagResourceHTML, iterTagResourceHTML, documentToHTML, generateTagResourcesHTML, buildDocumentTree, ParseCache, OutputWriter, SimilarityIndex, MinHashIndex, Instruments, NullInstruments, setInstruments, Watcher, applyChanges, TreeSnapshot, compileTemplate, tagFilePath, TagNormalizer, modifyTags, buildShardedDocumentTree
+
+POST = "%s\nmeta-creation_date: 8/13/2012 10:20\nTags: atag, btag\n\n<p>%s excerpt</p><p>[[ctag c tag]]</p>\n"
+
+def writePosts(directory, count):
+    """Write count posts to directory returning their file names"""
+    fileNames = []
+    for i in range(count):
+        fileName = os.path.join(directory, "post%d.txt" % i)
+        with open(fileName, "w") as fp:
+            fp.write(POST % ("Post %d" % i, "Post %d" % i))
+        fileNames.append(fileName)
+    return fileNames
+
+class OlderDocument(Document):
+    """A Document class from before lazy loading"""
+    __slots__ = ()
+    def __init__(self, url='', file=None):
+        Document.__init__(self, url=url, file=file)
 
 def treeWithSomeOverlap():
     tree = DocumentTree()
@@ -51,6 +75,343 @@ class BuildingDocumentTree(Vows.Context):
         def doc4_has_two_related_docs_w(self, tree):
             expect(list(tree.documents[4].related)).to_be_like([tree.documents[5], tree.documents[6]])
 
+    class UpdateRelatedOrderingAndIgnoredTags(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            doc0 = Document(title="Doc 0", date=datetime(2012, 1, 1), tags=('xtag', 'ytag'))
+            doc1 = Document(title="Doc 1", date=datetime(2011, 1, 1), tags=('xtag', 'ytag'))
+            doc2 = Document(title="Doc 2", date=datetime(2010, 1, 1), tags=('xtag',))
+            doc3 = Document(title="Doc 3", date=datetime(2013, 1, 1), tags=('xtag',))
+            doc4 = Document(title="Doc 4", date=datetime(2014, 1, 1), tags=('ytag', 'ztag'))
+            for doc in (doc0, doc1, doc2, doc3, doc4):
+                tree.add(doc)
+            tree.updateRelated(ignoreTags=['ytag'])
+            return tree
+
+        def most_shared_tags_then_newest_first(self, tree):
+            docs = tree.documents
+            expect(docs[0].related).to_equal([docs[1], docs[3], docs[2]])
+
+        def ignored_tags_do_not_find_candidates(self, tree):
+            expect(tree.documents[4].related).to_be_empty()
+
+
+    class UpdateRelatedWeightedByTags(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            doc0 = Document(title="Doc 0", date=datetime(2012, 1, 1), tags=('common', 'rare', 'xtag'))
+            doc1 = Document(title="Doc 1", date=datetime(2011, 1, 1), tags=('common', 'rare'))
+            doc2 = Document(title="Doc 2", date=datetime(2013, 1, 1), tags=('common', 'xtag', 'ytag'))
+            doc3 = Document(title="Doc 3", date=datetime(2014, 1, 1), tags=('common', 'xtag', 'ytag'))
+            doc4 = Document(title="Doc 4", date=datetime(2010, 1, 1), tags=('common',))
+            for doc in (doc0, doc1, doc2, doc3, doc4):
+                tree.add(doc)
+            tree.updateRelated(scoring='idf')
+            return tree
+
+        def rarer_shared_tags_rank_first(self, tree):
+            docs = tree.documents
+            expect(docs[0].related).to_equal([docs[1], docs[3], docs[2]])
+
+        def tags_on_every_document_do_not_relate(self, tree):
+            expect(tree.documents[4].related).to_be_empty()
+
+        def batched_and_per_document_scores_agree(self, tree):
+            for scoring in SimilarityIndex.scorings:
+                index = SimilarityIndex(tree.documents, scoring=scoring)
+                expect(index.relatedAll(limit=None)).to_equal([index.related(doc, limit=None) for doc in tree.documents])
+
+        def unknown_scoring_is_an_error(self, tree):
+            try:
+                tree.updateRelated(scoring='bogus')
+            except ValueError:
+                return
+            raise AssertionError("Expected ValueError")
+
+    class UpdateRelatedApproximately(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            doc0 = Document(title="Doc 0", date=datetime(2012, 1, 1), tags=('atag', 'btag', 'ctag'))
+            doc1 = Document(title="Doc 1", date=datetime(2011, 1, 1), tags=('atag', 'btag', 'ctag'))
+            doc2 = Document(title="Doc 2", date=datetime(2013, 1, 1), tags=('atag', 'btag', 'ctag', 'dtag'))
+            doc3 = Document(title="Doc 3", date=datetime(2014, 1, 1), tags=('xtag', 'ytag'))
+            doc4 = Document(title="Doc 4", date=datetime(2010, 1, 1), tags=('ztag',))
+            for doc in (doc0, doc1, doc2, doc3, doc4):
+                tree.add(doc)
+            tree.updateRelated(approximate=True)
+            return tree
+
+        def same_tags_are_always_candidates(self, tree):
+            docs = tree.documents
+            expect(docs[0].related).to_include(docs[1])
+            expect(docs[1].related).to_include(docs[0])
+
+        def candidates_are_scored_exactly(self, tree):
+            docs = tree.documents
+            for doc in docs[:3]:
+                expect(set(doc.related) - set([docs[0], docs[1], docs[2]])).to_be_empty()
+
+        def no_shared_tags_are_never_candidates(self, tree):
+            expect(tree.documents[3].related).to_be_empty()
+            expect(tree.documents[4].related).to_be_empty()
+
+        def batched_and_per_document_candidates_agree(self, tree):
+            index = MinHashIndex(SimilarityIndex(tree.documents, scoring='jaccard'))
+            expect(index.relatedAll(limit=None)).to_equal([index.related(doc, limit=None) for doc in tree.documents])
+
+        def options_are_passed_to_the_index(self, tree):
+            docs = [Document(title="Doc %d" % i, date=datetime(2012, 1, i + 1),
+                             tags=['tag%d' % j for j in range(i, i + 4)])
+                    for i in range(8)]
+            exact = SimilarityIndex(docs, scoring='jaccard')
+            tree = DocumentTree()
+            for doc in docs:
+                tree.add(doc)
+            for options in ({'numHashes': 4, 'bandSize': 4, 'seed': 1}, {'numHashes': 32, 'bandSize': 1}):
+                tree.updateRelated(scoring='jaccard', approximate=options, limit=None)
+                expect([doc.related for doc in docs]).to_equal(MinHashIndex(exact, **options).relatedAll(limit=None))
+
+        def unicode_tags_are_hashed(self, tree):
+            docs = [Document(title="Doc %d" % i, date=datetime(2012, 1, i + 1), tags=[u"caf\xe9", u"tag%d" % (i % 2)])
+                    for i in range(4)]
+            exact = SimilarityIndex(docs, scoring='cosine')
+            expect(MinHashIndex(exact).relatedAll(limit=None)).to_equal([exact.related(doc, limit=None) for doc in docs])
+
+        def documents_without_weighted_tags_are_not_divided_by(self, tree):
+            docs = [Document(title="Doc %d" % i, date=datetime(2012, 1, i + 1),
+                             tags=('all',) if i == 0 else ('all', 'tag%d' % (i % 2)))
+                    for i in range(6)]
+            exact = SimilarityIndex(docs, scoring='cosine')
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", RuntimeWarning)
+                related = MinHashIndex(exact).relatedAll(limit=None)
+            expect(related).to_equal([exact.related(doc, limit=None) for doc in docs])
+
+    class QueryDocuments(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            docs = [Document(title="Doc %d" % i, date=datetime(2010 + i // 4, 1 + i % 4 * 3, 1), tags=tags)
+                    for i, tags in enumerate([('atag',), ('atag', 'btag'), ('btag',), ('atag', 'ctag'),
+                                              ('atag', 'btag'), ('ctag',), ('atag', 'btag', 'ctag'), ('btag',)])]
+            for doc in docs:
+                tree.add(doc)
+            return tree, docs
+
+        def tag_is_newest_first(self, topic):
+            tree, docs = topic
+            expect(tree.query(tags=['atag'])).to_equal([docs[6], docs[4], docs[3], docs[1], docs[0]])
+
+        def tags_intersect(self, topic):
+            tree, docs = topic
+            expect(tree.query(tags=['atag', 'btag'])).to_equal([docs[6], docs[4], docs[1]])
+
+        def any_tags_unite(self, topic):
+            tree, docs = topic
+            expect(tree.query(anyTags=['ctag', 'btag'])).to_equal([docs[7], docs[6], docs[5], docs[4], docs[3], docs[2], docs[1]])
+
+        def excluded_tags_are_left_out(self, topic):
+            tree, docs = topic
+            expect(tree.query(tags=['atag'], excludeTags=['btag'])).to_equal([docs[3], docs[0]])
+
+        def dates_are_from_since_up_to_before(self, topic):
+            tree, docs = topic
+            expect(tree.query(since=datetime(2010, 7, 1), before=datetime(2011, 4, 1))).to_equal([docs[4], docs[3], docs[2]])
+
+        def pages_are_offset_and_limited(self, topic):
+            tree, docs = topic
+            expect(tree.query(tags=['atag'], offset=1, limit=2)).to_equal([docs[4], docs[3]])
+
+        def unknown_tags_match_nothing(self, topic):
+            tree, docs = topic
+            expect(tree.query(tags=['atag', 'nosuchtag'])).to_be_empty()
+
+        def changes_are_seen(self, topic):
+            tree, docs = topic
+            newest = Document(title="Newest", date=datetime(2020, 1, 1), tags=('atag',))
+            tree.add(newest)
+            try:
+                expect(tree.query(tags=['atag'], limit=1)).to_equal([newest])
+            finally:
+                tree.remove(newest)
+
+    class MergeShards(Vows.Context):
+        def topic(self):
+            whole = treeWithSomeOverlap()
+            docs = treeWithSomeOverlap().documents
+            first, second = DocumentTree(), DocumentTree()
+            for doc in docs[:3]:
+                first.add(doc)
+            for doc in docs[3:]:
+                second.add(doc)
+            second.remove(docs[4])
+            whole.remove(whole.documents[4])
+            merged = DocumentTree.merge([first, second])
+            whole.updateRelated()
+            merged.updateRelated()
+            try:
+                DocumentTree.merge([first, DocumentTree.merge([first])])
+                duplicate = None
+            except ValueError as error:
+                duplicate = error
+            return whole, merged, duplicate
+
+        def tags_are_merged(self, topic):
+            whole, merged, duplicate = topic
+            expect(merged.tagCounts()).to_equal(whole.tagCounts())
+            expect(merged.cloudify(minCount=1)).to_equal(sorted(whole.cloudify(minCount=1)))
+
+        def postings_are_remapped(self, topic):
+            whole, merged, duplicate = topic
+            for tag in whole.tags:
+                expect([doc.title for doc in merged.tags[tag]]).to_equal([doc.title for doc in whole.tags[tag]])
+                expect([doc.title for doc in merged.query(tags=[tag])]).to_equal([doc.title for doc in whole.query(tags=[tag])])
+
+        def related_documents_cover_every_shard(self, topic):
+            whole, merged, duplicate = topic
+            expect([[related.title for related in doc.related] for doc in merged.documents]).to_equal(
+                [[related.title for related in doc.related] for doc in whole.documents])
+
+        def documents_in_two_shards_are_refused(self, topic):
+            expect(topic[2]).to_be_an_error_like(ValueError)
+
+    class BuildShardsInProcesses(Vows.Context):
+        def topic(self):
+            directory = tempfile.mkdtemp()
+            roots = []
+            for site in ("one", "two"):
+                root = os.path.join(directory, site)
+                os.makedirs(root)
+                writePosts(root, 3)
+                roots.append((root, "/%s/" % site))
+            inProcess = buildShardedDocumentTree(roots)
+            inWorkers = buildShardedDocumentTree(roots, workers=2)
+            shutil.rmtree(directory)
+            return inProcess, inWorkers
+
+        def documents_are_the_same(self, topic):
+            inProcess, inWorkers = topic
+            expect(len(inWorkers.documents)).to_equal(6)
+            expect([(doc.title, doc.url, doc.file, doc.tags) for doc in inWorkers.documents]).to_equal(
+                [(doc.title, doc.url, doc.file, doc.tags) for doc in inProcess.documents])
+
+        def every_root_is_included(self, topic):
+            expect(topic[1].documents[0].file).to_include(os.path.join('one', 'post0.txt'))
+            expect(topic[1].documents[3].file).to_include(os.path.join('two', 'post0.txt'))
+
+        def tags_are_counted_across_roots(self, topic):
+            expect(topic[1].tagCounts()['atag']).to_equal(6)
+
+    class BuildNonAsciiShardsInProcesses(Vows.Context):
+        def topic(self):
+            directory = tempfile.mkdtemp()
+            roots = []
+            for site in ("one", "two"):
+                root = os.path.join(directory, site)
+                os.makedirs(root)
+                for i in range(3):
+                    with open(os.path.join(root, "post%d.txt" % i), "w") as fp:
+                        fp.write(POST.replace("btag", "caf\xc3\xa9") % ("Caf\xc3\xa9 %d" % i, "Na\xc3\xafve %d" % i))
+                roots.append((root, "/%s/" % site))
+            builds = []
+            for workers in (None, 2):
+                tree = buildShardedDocumentTree(roots, workers=workers)
+                rendered = [doc.render(formattedTags=tagsToHTML(sortedTags(doc.tags))) for doc in tree.documents]
+                pages = [tagResourceHTML(tag, tree.query(tags=[tag])) for tag in sorted(tree.tags)]
+                builds.append((tree, rendered, pages))
+            shutil.rmtree(directory)
+            return builds
+
+        def tags_are_the_same(self, topic):
+            (inProcess, rendered, pages), (inWorkers, workerRendered, workerPages) = topic
+            expect(sorted(inWorkers.tags)).to_equal(sorted(inProcess.tags))
+            expect(inWorkers.tags).to_include("caf\xc3\xa9")
+            expect([(doc.title, doc.url, doc.tags) for doc in inWorkers.documents]).to_equal(
+                [(doc.title, doc.url, doc.tags) for doc in inProcess.documents])
+
+        def counts_are_the_same(self, topic):
+            (inProcess, rendered, pages), (inWorkers, workerRendered, workerPages) = topic
+            expect(inWorkers.tagCounts()).to_equal(inProcess.tagCounts())
+            expect(inWorkers.tagCounts()["caf\xc3\xa9"]).to_equal(6)
+
+        def rendered_output_is_the_same(self, topic):
+            (inProcess, rendered, pages), (inWorkers, workerRendered, workerPages) = topic
+            expect(workerRendered).to_equal(rendered)
+            expect(workerPages).to_equal(pages)
+            expect(rendered[0]).to_include("Caf\xc3\xa9 0")
+            expect(rendered[0]).to_include("Na\xc3\xafve 0")
+
+    class SaveAndLoadSnapshot(Vows.Context):
+        def topic(self):
+            tree = treeWithSomeOverlap()
+            tree.documents[2].file = "/blog/2.txt"
+            tree.remove(tree.documents[0])
+            # as parsed from a UTF-8 file
+            tree.documents[3].title = "Caf\xc3\xa9"
+            tree.documents[3].tags.add("caf\xc3\xa9")
+            tree.update(tree.documents[3])
+            directory = tempfile.mkdtemp()
+            fileName = os.path.join(directory, "tree.snapshot")
+            tree.save(fileName)
+            loaded = DocumentTree.load(fileName)
+            snapshot = TreeSnapshot(fileName)
+            tagged = dict((tag, [doc.title for doc in snapshot.tags[tag]]) for tag in snapshot.tags)
+            missing = 'nosuchtag' in snapshot.tags
+            snapshot.close()
+            with open(fileName, "wb") as fp:
+                fp.write("not a snapshot" * 10)
+            try:
+                TreeSnapshot(fileName)
+                badFile = None
+            except ValueError as error:
+                badFile = error
+            shutil.rmtree(directory)
+            return tree, loaded, tagged, missing, badFile
+
+        def non_ascii_strings_are_restored_as_they_were(self, topic):
+            tree, loaded, tagged, missing, badFile = topic
+            expect(tagged["caf\xc3\xa9"]).to_equal(["Caf\xc3\xa9"])
+            expect([doc.title for doc in loaded.tags["caf\xc3\xa9"]]).to_equal(["Caf\xc3\xa9"])
+            expect([type(tag) for tag in loaded.tags.keys()]).to_equal([str] * len(tree.tags.keys()))
+            expect(type(loaded.documents[3].title)).to_equal(str)
+
+        def restored_non_ascii_documents_render(self, topic):
+            tree, loaded, tagged, missing, badFile = topic
+            doc = loaded.documents[3]
+            expect(doc.render(formattedTags=tagsToHTML(sortedTags(doc.tags)))).to_equal(
+                tree.documents[3].render(formattedTags=tagsToHTML(sortedTags(tree.documents[3].tags))))
+            expect(tagResourceHTML("caf\xc3\xa9", loaded.query(tags=["caf\xc3\xa9"]), dateFormat="01/31/2012")).to_equal(
+                tagResourceHTML("caf\xc3\xa9", tree.query(tags=["caf\xc3\xa9"]), dateFormat="01/31/2012"))
+
+        def unicode_tags_are_saved_as_utf8(self, topic):
+            tree = DocumentTree()
+            tree.add(Document(title=u"Caf\xe9", date=datetime(2012, 1, 31), tags=[u"caf\xe9", u"atag"]))
+            directory = tempfile.mkdtemp()
+            fileName = os.path.join(directory, "tree.snapshot")
+            tree.save(fileName)
+            loaded = DocumentTree.load(fileName)
+            shutil.rmtree(directory)
+            expect(loaded.tagCounts()).to_equal({"caf\xc3\xa9": 1, "atag": 1})
+            expect(loaded.documents[0].title).to_equal("Caf\xc3\xa9")
+
+        def documents_are_restored(self, topic):
+            tree, loaded, tagged, missing, badFile = topic
+            expect([(doc.title, doc.url, doc.file, doc.excerpt, doc.date, doc.tags) for doc in loaded.documents]).to_equal(
+                [(doc.title, doc.url, doc.file, doc.excerpt, doc.date, doc.tags) for doc in tree.documents])
+
+        def tags_are_restored(self, topic):
+            tree, loaded, tagged, missing, badFile = topic
+            expect(sorted(loaded.tags.keys())).to_equal(sorted(tree.tags.keys()))
+            for tag in tree.tags:
+                expect([doc.title for doc in loaded.tags[tag]]).to_equal([doc.title for doc in tree.tags[tag]])
+
+        def snapshot_finds_tags_without_loading(self, topic):
+            tree, loaded, tagged, missing, badFile = topic
+            expect(tagged).to_equal(dict((tag, [doc.title for doc in tree.tags[tag]]) for tag in tree.tags))
+            expect(missing).to_be_false()
+
+        def other_files_are_refused(self, topic):
+            tree, loaded, tagged, missing, badFile = topic
+            expect(badFile).to_be_an_error_like(ValueError)
 
     class AddSixDocumentsWithSixTags(Vows.Context):
 
@@ -134,6 +495,28 @@ class BuildingDocumentTree(Vows.Context):
             cloud = sorted(cloud, key=operator.itemgetter(0))
             expect(htmlCloud(cloud)).to_equal("""<div class="tag-cloud"><a class="tag-6" href="/blog/tags/atag.htm">atag</a> <a class="tag-5" href="/blog/tags/btag.htm">btag</a> <a class="tag-4" href="/blog/tags/ctag.htm">ctag</a> <a class="tag-3" href="/blog/tags/dtag.htm">dtag</a> <a class="tag-2" href="/blog/tags/etag.htm">etag</a> </div>""")
 
+        def should_create_cloud_with_three_quantile_weights(self, topic):
+            tree, doc1, doc2, doc3, doc4, doc5, doc6 = topic
+            cloud = tree.cloudify(minCount=0, numBuckets=3, suffix=".htm", baseURL="/blog/tags/", algo='quantile')
+            expect(cloud).to_be_like([('atag', 3, "/blog/tags/atag.htm"),
+                                      ('btag', 3, "/blog/tags/btag.htm"),
+                                      ('ctag', 2, "/blog/tags/ctag.htm"),
+                                      ('dtag', 2, "/blog/tags/dtag.htm"),
+                                      ('etag', 1, "/blog/tags/etag.htm"),
+                                      ('ftag', 1, "/blog/tags/ftag.htm")])
+
+        def should_bucket_the_same_with_and_without_numpy(self, topic):
+            counts = [0, 1, 2, 3, 5, 8, 13, 21, 34, 55]
+            for algo in ('log', 'count', 'quantile'):
+                buckets = cloudBuckets(counts, numBuckets=4, algo=algo)
+                if tagging.numpy is not None:
+                    expect(cloudBuckets(tagging.numpy.array(counts), numBuckets=4, algo=algo).tolist()).to_equal(buckets)
+            expect(cloudBuckets(counts, numBuckets=4, algo='quantile')[1:]).to_equal([1, 1, 1, 2, 2, 3, 3, 4, 4])
+
+        def should_count_documents_per_tag(self, topic):
+            tree, doc1, doc2, doc3, doc4, doc5, doc6 = topic
+            expect(tree.tagCounts()).to_equal({'atag': 6, 'btag': 5, 'ctag': 4, 'dtag': 3, 'etag': 2, 'ftag': 1})
+
         # def create_html_document_for_one_tag(self, topic):
         #     """Yes this is a horrible and brittle test..."""
         #     tree, doc1, doc2, doc3, doc4, doc5, doc6 = topic
@@ -173,6 +556,333 @@ class BuildingDocumentTree(Vows.Context):
                 def no_test_files_exist(self, topic):
                     expect(os.path.exists(topic)).to_be_false()
 
+    class RemoveAndUpdateDocuments(Vows.Context):
+        def topic(self):
+            tree = treeWithSomeOverlap()
+            docs = list(tree.documents)
+            tree.clearDirty()
+            tree.remove(docs[0])
+            docs[2].tags = set(['btag', 'qtag'])
+            tree.update(docs[2])
+            return tree, docs
+
+        def removed_document_is_gone(self, topic):
+            tree, docs = topic
+            expect(tree.documents).Not.to_include(docs[0])
+
+        def tag_of_removed_document_is_gone(self, topic):
+            tree, docs = topic
+            expect(tree.tags).Not.to_include('ATAG')
+
+        def updated_document_is_listed_under_new_tag(self, topic):
+            tree, docs = topic
+            expect(tree.tags['qtag']).to_equal([docs[2]])
+
+        def updated_document_is_no_longer_listed_under_old_tag(self, topic):
+            tree, docs = topic
+            expect(tree.tags['ztag']).to_equal([docs[3], docs[6]])
+
+        def only_affected_tags_are_dirty(self, topic):
+            tree, docs = topic
+            expect(tree.dirtyTags).to_equal(set(['ATAG', 'btag', 'ztag', 'qtag']))
+
+        def documents_sharing_changed_tags_are_dirty(self, topic):
+            tree, docs = topic
+            expect(tree.dirtyDocuments).to_equal(set([docs[2], docs[3], docs[5], docs[6]]))
+
+        def cloud_is_dirty(self, topic):
+            tree, docs = topic
+            expect(tree.dirtyCloud).to_be_true()
+
+    class ReplaceDocumentForSameFile(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            old = Document(title="Old", tags=('atag',))
+            old.file = 'post.txt'
+            tree.add(old)
+            tree.clearDirty()
+            new = Document(title="New", tags=('atag',))
+            new.file = 'post.txt'
+            tree.update(new)
+            return tree, new
+
+        def new_document_replaces_old(self, topic):
+            tree, new = topic
+            expect(tree.documents).to_equal([new])
+            expect(tree.tags['atag']).to_equal([new])
+
+        def tag_page_is_dirty_but_cloud_is_not(self, topic):
+            tree, new = topic
+            expect(tree.dirtyTags).to_equal(set(['atag']))
+            expect(tree.dirtyCloud).to_be_false()
+
+    class CompactTagIndex(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            doc0 = Document(title="Doc 0", tags=(''.join(['a', 'tag']),))
+            doc1 = Document(title="Doc 1", tags=(''.join(['at', 'ag']), 'btag'))
+            tree.add(doc0)
+            tree.add(doc1)
+            return tree, doc0, doc1
+
+        def documents_share_tag_names(self, topic):
+            tree, doc0, doc1 = topic
+            expect(list(doc0.tags)[0] is [tag for tag in doc1.tags if tag == 'atag'][0]).to_be_true()
+
+        def tag_lists_documents_in_order(self, topic):
+            tree, doc0, doc1 = topic
+            expect(list(tree.tags['atag'])).to_equal([doc0, doc1])
+            expect(tree.tags['atag'][1]).to_equal(doc1)
+            expect(len(tree.tags['btag'])).to_equal(1)
+
+        def tags_is_a_read_only_dict_view(self, topic):
+            tree, doc0, doc1 = topic
+            expect(sorted(tree.tags.keys())).to_equal(['atag', 'btag'])
+            expect(tree.tags.get('ctag')).to_be_null()
+            expect(dict(tree.tags.items())).to_equal({'atag': [doc0, doc1], 'btag': [doc1]})
+
+        def documents_have_no_instance_dict(self, topic):
+            expect(hasattr(topic[1], '__dict__')).to_be_false()
+
+    class NormalizeTags(Vows.Context):
+        def topic(self):
+            normalizer = TagNormalizer(ignore=['ToDo'], aliases={'fyc': 'ForYourK9'}, caseFold=True,
+                                       rewrites=[(r'^tag-', '')])
+            tree = DocumentTree(normalizer=normalizer)
+            doc0 = Document(title="Doc 0", date=datetime(2012, 1, 30), tags=('ATAG', 'todo'), url='0.html')
+            doc1 = Document(title="Doc 1", date=datetime(2012, 1, 31), tags=('atag', 'tag-FYC'), url='1.html')
+            tree.add(doc0)
+            tree.add(doc1)
+            before = dict(tree.tagCounts())
+            tree.clearDirty()
+            tree.renormalize(TagNormalizer(aliases={'ATAG': 'atag'}))
+            return tree, normalizer, before, doc0, doc1
+
+        def tags_are_listed_normalized(self, topic):
+            tree, normalizer, before, doc0, doc1 = topic
+            expect(before).to_equal({'atag': 2, 'ForYourK9': 1})
+
+        def each_tag_is_normalized_once(self, topic):
+            tree, normalizer, before, doc0, doc1 = topic
+            expect(normalizer._table).to_equal({'ATAG': 'atag', 'todo': None, 'atag': 'atag', 'tag-FYC': 'ForYourK9'})
+
+        def unchanged_tags_are_returned_as_they_are(self, topic):
+            tags = set(['atag'])
+            expect(topic[1].normalize(tags)).to_equal(tags)
+            expect(topic[1].normalize(tags) is tags).to_be_true()
+
+        def renormalizing_starts_from_the_tags_documents_were_added_with(self, topic):
+            tree, normalizer, before, doc0, doc1 = topic
+            expect(tree.tagCounts()).to_equal({'atag': 2, 'todo': 1, 'tag-FYC': 1})
+            expect(doc0.tags).to_equal(set(['atag', 'todo']))
+
+        def renormalized_documents_are_dirty(self, topic):
+            tree, normalizer, before, doc0, doc1 = topic
+            expect(tree.dirtyTags).to_equal(set(['atag', 'todo', 'ForYourK9', 'tag-FYC']))
+            expect(tree.dirtyDocuments).to_equal(set([doc0, doc1]))
+            expect((doc0.version, doc1.version)).to_equal((1, 1))
+
+        def modify_tags_uses_its_arguments(self, topic):
+            doc = Document(tags=('a', 'b', 'c'))
+            modifyTags(doc, ignores=['a'], replacements={'b': 'B'})
+            expect(doc.tags).to_equal(set(['B', 'c']))
+
+    class StreamTagPages(Vows.Context):
+        def topic(self):
+            tree = treeWithSomeOverlap()
+            directory = tempfile.mkdtemp()
+            generateTagResourcesHTML(tree, ['atag', 'xtag'], directory, dateFormat="01/31/2012")
+            written = open(os.path.join(directory, "atag.txt")).read()
+            shutil.rmtree(directory)
+            formatted = []
+            def formatter(doc):
+                formatted.append(doc)
+                return doc.title
+            fragments = {}
+            pages = ["".join(iterTagResourceHTML(tag, tree.tags[tag], docFormatter=formatter, fragments=fragments))
+                     for tag in ('atag', 'xtag', 'ytag')]
+            return tree, written, formatted, pages
+
+        def written_page_is_the_same_as_tag_resource(self, topic):
+            tree, written, formatted, pages = topic
+            docs = sorted(tree.tags['atag'], key=lambda x: x.date, reverse=True)
+            expect(written).to_equal(tagResourceHTML('atag', docs, dateFormat="01/31/2012"))
+
+        def each_document_is_formatted_once(self, topic):
+            tree, written, formatted, pages = topic
+            expect(len(formatted)).to_equal(len(set(formatted)))
+            expect(set(formatted)).to_equal(set(tree.documents[1:]).difference([tree.documents[2]]))
+
+        def pages_include_every_document(self, topic):
+            tree, written, formatted, pages = topic
+            expect(pages[1]).to_include('<div class="tag-docs">Doc 4Doc 5Doc 6</div>')
+
+    class MemoizeFragmentsOfTreesLargerThanTheCache(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            tags = ['atag', 'btag', 'ctag', 'dtag', 'etag', 'ftag']
+            for i in range(40):
+                tree.add(Document(title="Doc %d" % i, date=datetime(2012, 1, 1 + i % 28),
+                                  tags=[tags[i % 6], tags[(i + 1) % 6], tags[i // 7]], url='%d.html' % i))
+            maxSize = tagging.FRAGMENT_CACHE.maxSize
+            tagging.FRAGMENT_CACHE.clear()
+            tagging.FRAGMENT_CACHE.maxSize = 10
+            tagging.FRAGMENT_CACHE.hits = tagging.FRAGMENT_CACHE.misses = 0
+            directory = tempfile.mkdtemp()
+            try:
+                generateTagResourcesHTML(tree, tree.tags, directory)
+                misses = tagging.FRAGMENT_CACHE.misses
+            finally:
+                shutil.rmtree(directory)
+                tagging.FRAGMENT_CACHE.clear()
+                tagging.FRAGMENT_CACHE.maxSize = maxSize
+            tagLists = set(tuple(sortedTags(doc.tags)) for doc in tree.documents)
+            return misses, len(tree.documents) + len(tagLists)
+
+        def each_fragment_is_generated_once(self, topic):
+            misses, fragments = topic
+            expect(misses).to_equal(fragments)
+
+    class MemoizeDocumentFragments(Vows.Context):
+        def topic(self):
+            tree = treeWithSomeOverlap()
+            doc = tree.documents[3]
+            cache = FragmentCache(maxSize=2)
+            tagFormatter = functools.partial(tagsToHTML, cache=cache)
+            first = documentToHTML(doc, tagFormatter=tagFormatter, cache=cache)
+            documentToHTML(doc, tagFormatter=tagFormatter, cache=cache)
+            tagsToHTML(sortedTags(doc.tags), cache=cache)
+            hits = cache.hits
+            doc.title = "Doc Three"
+            tree.update(doc)
+            updated = documentToHTML(doc, tagFormatter=tagFormatter, cache=cache)
+            return cache, first, hits, updated
+
+        def fragments_are_generated_once(self, topic):
+            cache, first, hits, updated = topic
+            expect(hits).to_equal(2)
+            expect(first).to_equal(documentToHTML(Document(title="Doc 3", date=datetime(2012, 1, 31),
+                                                           excerpt="Document three.", tags=('atag', 'ztag', 'dtag'),
+                                                           url='3.html'), cache=None))
+
+        def updated_documents_are_generated_again(self, topic):
+            cache, first, hits, updated = topic
+            expect(updated).to_include("Doc Three")
+
+        def cache_size_is_bounded(self, topic):
+            cache, first, hits, updated = topic
+            expect(len(cache)).to_equal(2)
+
+    class CompileTemplates(Vows.Context):
+        def topic(self):
+            class HashTemplate(string.Template):
+                delimiter = '#'
+            class UpperTemplate(string.Template):
+                def safe_substitute(self, **kws):
+                    return string.Template.safe_substitute(self, **kws).upper()
+            template = string.Template("100% $a $$ ${b} $c $")
+            kws = {'a': 'x', 'b': (1, 2)}
+            return template, kws, HashTemplate("# #a ##"), UpperTemplate("$name")
+
+        def compiled_templates_render_like_safe_substitute(self, topic):
+            template, kws, hashTemplate, upperTemplate = topic
+            expect(compileTemplate(template)(**kws)).to_equal(template.safe_substitute(**kws))
+            expect(compileTemplate(template)()).to_equal(template.safe_substitute())
+            expect(compileTemplate(hashTemplate)(a=1)).to_equal("# 1 #")
+
+        def templates_are_compiled_once(self, topic):
+            template = topic[0]
+            expect(compileTemplate(template)).to_equal(compileTemplate(template))
+
+        def overridden_templates_are_used(self, topic):
+            expect(compileTemplate(topic[3])(name="x")).to_equal("X")
+            expect(tagsToHTML(['atag'], tagTemplate=topic[3], cache=None)).to_include('<ul class="tags">ATAG</ul>')
+
+        def tag_urls_are_cached(self, topic):
+            cache = {}
+            expect(tagFilePath('atag', cache=cache)).to_equal('/blog/tags/atag.html')
+            expect(cache).to_equal({('atag', '/blog/tags/', 'html'): '/blog/tags/atag.html'})
+
+    class SkipUnchangedTagPages(Vows.Context):
+        def topic(self):
+            tree = treeWithSomeOverlap()
+            directory = tempfile.mkdtemp()
+            first = generateTagResourcesHTML(tree, ['atag', 'xtag'], directory, dateFormat="01/30/2012", skipUnchanged=True)
+            second = generateTagResourcesHTML(tree, ['atag', 'xtag'], directory, dateFormat="01/31/2012", skipUnchanged=True)
+            tree.documents[6].title = "Doc Six"
+            tree.update(tree.documents[6])
+            third = generateTagResourcesHTML(tree, ['atag', 'xtag'], directory, dateFormat="01/31/2012", skipUnchanged=True)
+            shutil.rmtree(directory)
+            return first, second, third
+
+        def new_pages_are_written(self, topic):
+            expect((topic[0].written, topic[0].skipped)).to_equal((2, 0))
+
+        def pages_differing_only_by_date_are_skipped(self, topic):
+            expect((topic[1].written, topic[1].skipped)).to_equal((0, 2))
+
+        def changed_pages_are_written(self, topic):
+            expect((topic[2].written, topic[2].skipped)).to_equal((1, 1))
+
+    class PaginateTagPages(Vows.Context):
+        def topic(self):
+            tree = DocumentTree()
+            for i in range(5):
+                tree.add(Document(title="Doc %d" % i, date=datetime(2012, 1, i + 1), tags=('ptag',), url='%d.html' % i))
+            directory = tempfile.mkdtemp()
+            first = generateTagResourcesHTML(tree, ['ptag'], directory, dateFormat="01/30/2012",
+                                             skipUnchanged=True, pageSize=2)
+            files = sorted(os.path.relpath(os.path.join(path, name), directory)
+                           for path, dirs, names in os.walk(directory) for name in names)
+            pages = dict((name, open(os.path.join(directory, name)).read()) for name in files)
+            tree.add(Document(title="Doc 5", date=datetime(2012, 1, 6), tags=('ptag',), url='5.html'))
+            second = generateTagResourcesHTML(tree, ['ptag'], directory, dateFormat="01/31/2012",
+                                              skipUnchanged=True, pageSize=2)
+            shutil.rmtree(directory)
+            return tree, files, pages, first, second
+
+        def older_pages_are_numbered_from_the_oldest(self, topic):
+            tree, files, pages, first, second = topic
+            expect(files).to_equal(['ptag.txt', 'ptag/1.txt', 'ptag/2.txt'])
+            expect(pages['ptag/1.txt']).to_include('Doc 1')
+            expect(pages['ptag/1.txt']).to_include('Doc 0')
+            expect(pages['ptag.txt']).to_include('Doc 4')
+            expect(pages['ptag.txt']).Not.to_include('Doc 3')
+
+        def pages_link_to_newer_and_older_pages(self, topic):
+            tree, files, pages, first, second = topic
+            expect(pages['ptag.txt']).to_include('<div class="pager"><a class="older" href="/blog/tags/ptag/2.html">Older</a></div>')
+            expect(pages['ptag/2.txt']).to_include('<a class="newer" href="/blog/tags/ptag.html">Newer</a>'
+                                                   '<a class="older" href="/blog/tags/ptag/1.html">Older</a>')
+            expect(pages['ptag/1.txt']).to_include('<a class="newer" href="/blog/tags/ptag/2.html">Newer</a></div>')
+
+        def a_new_document_only_rewrites_the_first_page(self, topic):
+            tree, files, pages, first, second = topic
+            expect((first.written, first.skipped)).to_equal((3, 0))
+            expect((second.written, second.skipped)).to_equal((1, 2))
+
+        def pages_a_shrunk_tag_no_longer_has_are_removed(self, topic):
+            tree = DocumentTree()
+            for i in range(21):
+                tree.add(Document(title="Doc %d" % i, date=datetime(2012, 1, i + 1), tags=('ptag',), url='%d.html' % i))
+            directory = tempfile.mkdtemp()
+            generateTagResourcesHTML(tree, ['ptag'], directory, pageSize=10)
+            before = sorted(os.listdir(os.path.join(directory, 'ptag')))
+            tree.remove(tree.documents[20])
+            generateTagResourcesHTML(tree, ['ptag'], directory, pageSize=10)
+            after = sorted(os.listdir(os.path.join(directory, 'ptag')))
+            shutil.rmtree(directory)
+            expect(before).to_equal(['1.txt', '2.txt'])
+            expect(after).to_equal(['1.txt'])
+
+        def tag_resource_renders_a_single_page(self, topic):
+            tree, files, pages, first, second = topic
+            docs = tree.query(tags=['ptag'])
+            html = tagResourceHTML('ptag', docs, pageSize=2, page=1)
+            expect(html).to_include('Doc 1')
+            expect(html).Not.to_include('Doc 2')
+            expect(tagResourceHTML('ptag', docs)).Not.to_include('class="pager"')
+
     class AddDocumentsWithoutTags(Vows.Context):
         def topic(self):
             tree = DocumentTree()
@@ -185,6 +895,357 @@ class BuildingDocumentTree(Vows.Context):
             expect(tree.tags.keys()).to_be_empty()
 
 
+@Vows.batch
+class CachingParsedDocuments(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        fileNames = writePosts(directory, 3)
+        cache = ParseCache(os.path.join(directory, "cache"))
+        buildDocumentTree(directory, cache=cache)
+        firstMisses = cache.misses
+        tree = buildDocumentTree(directory, cache=cache)
+        with open(fileNames[0], "a") as fp:
+            fp.write("<p>more</p>")
+        buildDocumentTree(directory, cache=cache)
+        cache.close()
+        body = tree.documents[1].body
+        tree.documents[1].write(fileNames[1], formattedTags="TAGS")
+        written = open(fileNames[1]).read()
+        shutil.rmtree(directory)
+        return firstMisses, cache, tree, body, written
+
+    def first_build_parses_every_file(self, topic):
+        expect(topic[0]).to_equal(3)
+
+    def unchanged_files_are_not_parsed_again(self, topic):
+        expect(topic[1].hits).to_equal(5)
+
+    def changed_file_is_parsed_again(self, topic):
+        expect(topic[1].misses).to_equal(4)
+
+    def cached_document_has_title_and_excerpt(self, topic):
+        doc = sorted(topic[2].documents, key=lambda x: x.title)[0]
+        expect(doc.title).to_equal("Post 0")
+        expect(doc.excerpt).to_equal("Post 0 excerpt")
+
+    def cached_document_has_tags(self, topic):
+        expect(topic[2].documents[1].tags).to_include('ctag')
+        expect(topic[2].documents[1].tags).to_include('atag')
+
+    def body_is_read_when_needed(self, topic):
+        expect(topic[3]).to_equal("<p>Post 1 excerpt</p><p>[[ctag c tag]]</p>\n")
+
+    def rewriting_unchanged_document_is_skipped(self, topic):
+        doc = Document(title="A Title", date=datetime(2012, 1, 31), tags=('atag',), body="<p>body</p>")
+        directory = tempfile.mkdtemp()
+        fileName = os.path.join(directory, "post.txt")
+        written = [doc.write(fileName, skipUnchanged=True), doc.write(fileName, skipUnchanged=True)]
+        shutil.rmtree(directory)
+        expect(written).to_equal([True, False])
+
+    def rewriting_cached_document_keeps_body(self, topic):
+        expect(topic[4]).to_include("meta-tags: TAGS\n\n<p>Post 1 excerpt</p><p>[[ctag c tag]]</p>\n")
+
+    def deleted_files_are_forgotten(self, topic):
+        directory = tempfile.mkdtemp()
+        root = os.path.join(directory, "posts")
+        os.makedirs(root)
+        fileNames = writePosts(root, 2)
+        elsewhere = writePosts(directory, 1)[0]
+        cache = ParseCache(os.path.join(directory, "cache"))
+        cache.put(elsewhere, Document(file=elsewhere).record())
+        buildDocumentTree(root, cache=cache)
+        os.remove(fileNames[1])
+        buildDocumentTree(root, cache=cache)
+        cached = sorted([path for (path,) in cache._db.execute("SELECT path FROM records")])
+        cache.close()
+        shutil.rmtree(directory)
+        expect(cached).to_equal(sorted([fileNames[0], elsewhere]))
+
+
+@Vows.batch
+class ParsingDocumentsInParallel(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        writePosts(directory, 7)
+        serial = buildDocumentTree(directory)
+        parallel = buildDocumentTree(directory, workers=3)
+        shutil.rmtree(directory)
+        return serial, parallel
+
+    def documents_are_added_in_the_same_order(self, topic):
+        serial, parallel = topic
+        expect([doc.file for doc in parallel.documents]).to_equal([doc.file for doc in serial.documents])
+
+    def documents_have_the_same_information(self, topic):
+        serial, parallel = topic
+        expect([(doc.title, doc.date, doc.tags, doc.excerpt, doc.url) for doc in parallel.documents]).to_equal(
+            [(doc.title, doc.date, doc.tags, doc.excerpt, doc.url) for doc in serial.documents])
+
+    def cached_files_need_no_processes(self, topic):
+        directory = tempfile.mkdtemp()
+        writePosts(directory, 3)
+        cache = ParseCache(os.path.join(directory, "cache"))
+        buildDocumentTree(directory, cache=cache)
+        pools = []
+        Pool = tagging.multiprocessing.Pool
+        tagging.multiprocessing.Pool = lambda *args: pools.append(args)
+        try:
+            tree = buildDocumentTree(directory, cache=cache, workers=3)
+        finally:
+            tagging.multiprocessing.Pool = Pool
+        cache.close()
+        shutil.rmtree(directory)
+        expect(pools).to_be_empty()
+        expect(len(tree.documents)).to_equal(3)
+
+
+@Vows.batch
+class LoadingDocumentsLazily(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        fileName = os.path.join(directory, "post.txt")
+        with open(fileName, "w") as fp:
+            fp.write("A Title\nmeta-creation_date: 8/13/2012 10:20\nTags: atag\n\n"
+                     "<p>some text\ngoes here</p><p>[[btag b\ntag]] [[ctag c tag]]</p>\n")
+        eager = Document(file=fileName)
+        lazy = Document(file=fileName, lazy=True)
+        keptBody = lazy._body
+        body = lazy.body
+        shutil.rmtree(directory)
+        return eager, lazy, keptBody, body
+
+    def body_is_not_kept(self, topic):
+        expect(topic[2]).to_be_null()
+
+    def finds_the_same_tags(self, topic):
+        eager, lazy, keptBody, body = topic
+        expect(lazy.tags).to_equal(eager.tags)
+
+    def finds_the_same_excerpt(self, topic):
+        eager, lazy, keptBody, body = topic
+        expect(lazy.excerpt).to_equal("some text\ngoes here")
+        expect(lazy.excerpt).to_equal(eager.excerpt)
+
+    def body_is_read_when_needed(self, topic):
+        eager, lazy, keptBody, body = topic
+        expect(body).to_equal(eager.body)
+
+    def document_classes_without_lazy_still_work(self, topic):
+        directory = tempfile.mkdtemp()
+        writePosts(directory, 2)
+        cache = ParseCache(os.path.join(directory, "cache"))
+        trees = [buildDocumentTree(directory, docClass=OlderDocument),
+                 buildDocumentTree(directory, docClass=OlderDocument, workers=2),
+                 buildDocumentTree(directory, docClass=OlderDocument, cache=cache),
+                 buildDocumentTree(directory, docClass=OlderDocument, cache=cache)]
+        cache.close()
+        shutil.rmtree(directory)
+        for tree in trees:
+            expect([doc.title for doc in tree.documents]).to_equal(["Post 0", "Post 1"])
+            expect([type(doc) for doc in tree.documents]).to_equal([OlderDocument] * 2)
+        expect(trees[3].documents[0].tags).to_equal(trees[0].documents[0].tags)
+
+
+@Vows.batch
+class WritingOutputFiles(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        fileNames = [os.path.join(directory, "%d.txt" % i) for i in range(20)]
+        with open(fileNames[0], "w") as fp:
+            fp.write("old")
+        os.chmod(fileNames[0], 0640)
+        writer = OutputWriter(workers=4)
+        for i, fileName in enumerate(fileNames):
+            writer.write(fileName, ["file ", str(i)])
+        stats = writer.close()
+        contents = [open(fileName).read() for fileName in fileNames]
+        mode = os.stat(fileNames[0]).st_mode & 0777
+        with open(os.path.join(directory, "opened"), "w") as fp:
+            pass
+        newModes = (os.stat(fileNames[2]).st_mode & 0777, os.stat(fp.name).st_mode & 0777)
+        os.remove(fp.name)
+        def failing():
+            yield "partial"
+            raise IOError("disk full")
+        try:
+            OutputWriter(workers=1).write(fileNames[1], failing())
+        except IOError:
+            pass
+        afterFailure = open(fileNames[1]).read()
+        leftOver = sorted(os.listdir(directory))
+        shutil.rmtree(directory)
+        return writer, stats, contents, mode, afterFailure, leftOver, newModes
+
+    def every_file_is_written(self, topic):
+        writer, stats, contents, mode, afterFailure, leftOver, newModes = topic
+        expect(contents).to_equal(["file %d" % i for i in range(20)])
+        expect(stats.written).to_equal(20)
+
+    def every_file_is_timed(self, topic):
+        writer, stats, contents, mode, afterFailure, leftOver, newModes = topic
+        expect(writer.latencySummary()['count']).to_equal(20)
+
+    def existing_file_keeps_its_permissions(self, topic):
+        expect(topic[3]).to_equal(0640)
+
+    def new_file_has_the_permissions_open_gives(self, topic):
+        written, opened = topic[6]
+        expect(written).to_equal(opened)
+
+    def failed_write_leaves_file_unchanged(self, topic):
+        expect(topic[4]).to_equal("file 1")
+
+    def failed_write_leaves_no_temporary_file(self, topic):
+        expect(topic[5]).to_equal(sorted(["%d.txt" % i for i in range(20)]))
+
+
+@Vows.batch
+class ScanningDocumentFiles(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        for folder in ("a", "a/b", "tags", "tags/deep", "tagsmore"):
+            os.mkdir(os.path.join(directory, folder))
+        for fileName in ("one.txt", "a/two.txt", "a/b/three.txt", "a/b/four.md", "a/skip.html",
+                         "tags/page.txt", "tags/deep/page.txt", "tagsmore/five.txt"):
+            with open(os.path.join(directory, fileName), "w") as fp:
+                fp.write(fileName)
+        os.symlink(os.path.join(directory, "a"), os.path.join(directory, "link"))
+        blackList = [os.path.join(directory, "tags")]
+        scanned = tagging.scanDocumentFiles(directory, (".txt", ".md"), blackList, withStats=True)
+        scandir = tagging.scandir
+        tagging.scandir = None
+        try:
+            listed = tagging.scanDocumentFiles(directory, (".txt", ".md"), blackList, withStats=True)
+        finally:
+            tagging.scandir = scandir
+        found = tagging.findDocumentFiles(directory, ".txt", blackList)
+        shutil.rmtree(directory)
+        return directory, scanned, listed, found
+
+    def blacklisted_directories_are_pruned(self, topic):
+        directory, scanned, listed, found = topic
+        expect([os.path.relpath(path, directory) for path, stat in scanned]).to_equal(
+            ["a/b/four.md", "a/b/three.txt", "a/two.txt", "one.txt"])
+
+    def suffix_may_be_a_string(self, topic):
+        directory, scanned, listed, found = topic
+        expect([os.path.relpath(path, directory) for path in found]).to_equal(
+            ["a/b/three.txt", "a/two.txt", "one.txt"])
+
+    def stats_come_with_the_paths(self, topic):
+        directory, scanned, listed, found = topic
+        expect([stat.st_size for path, stat in scanned]).to_equal(
+            [len(os.path.relpath(path, directory)) for path, stat in scanned])
+
+    def listdir_fallback_finds_the_same(self, topic):
+        directory, scanned, listed, found = topic
+        expect([(path, stat.st_size) for path, stat in listed]).to_equal(
+            [(path, stat.st_size) for path, stat in scanned])
+
+@Vows.batch
+class WatchingForChanges(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        fileNames = writePosts(directory, 3)
+        tree = buildDocumentTree(directory, baseURL="/blog/")
+        tree.clearDirty()
+        watcher = Watcher(directory, interval=0.01, debounce=0.05)
+        with open(fileNames[0], "w") as fp:
+            fp.write("Post 0\nmeta-creation_date: 8/13/2012 10:20\nTags: atag, dtag\n\n<p>Changed</p>\n")
+        os.remove(fileNames[1])
+        added = os.path.join(directory, "post3.txt")
+        with open(added, "w") as fp:
+            fp.write(POST % ("Post 3", "Post 3"))
+        os.remove(fileNames[2])
+        changes = watcher.wait(timeout=5)
+        applyChanges(tree, *changes, baseURL="/blog/")
+        # as if rewritten by the tagger
+        Document(file=fileNames[0]).write(fileNames[0], formattedTags="tags")
+        watcher.ignore([fileNames[0]])
+        quiet = watcher.wait(timeout=0.05)
+        shutil.rmtree(directory)
+        return tree, fileNames, added, changes, quiet
+
+    def burst_of_changes_is_reported_once(self, topic):
+        tree, fileNames, added, changes, quiet = topic
+        expect(changes).to_equal(([added], [fileNames[0]], sorted(fileNames[1:])))
+
+    def only_changed_files_are_reparsed(self, topic):
+        tree, fileNames, added, changes, quiet = topic
+        expect(sorted([doc.file for doc in tree.documents])).to_equal([fileNames[0], added])
+        expect(tree.tags['dtag']).to_equal([doc for doc in tree.documents if doc.file == fileNames[0]])
+
+    def affected_tags_are_dirty(self, topic):
+        tree, fileNames, added, changes, quiet = topic
+        expect(tree.dirtyTags.issuperset(['atag', 'btag', 'ctag', 'dtag'])).to_be_true()
+        expect(tree.dirtyCloud).to_be_true()
+
+    def own_writes_are_ignored(self, topic):
+        tree, fileNames, added, changes, quiet = topic
+        expect(quiet).to_be_null()
+
+    def malformed_files_leave_their_documents_alone(self, topic):
+        directory = tempfile.mkdtemp()
+        fileNames = writePosts(directory, 2)
+        tree = buildDocumentTree(directory)
+        previous = tree.documents[0]
+        with open(fileNames[0], "w") as fp:
+            fp.write("Post 0\nmeta-creation_date: 13/45/2012\nTags: dtag\n\n<p>Broken</p>\n")
+        failed = applyChanges(tree, changed=fileNames)
+        shutil.rmtree(directory)
+        expect([filePath for filePath, error in failed]).to_equal([fileNames[0]])
+        expect(tree.documents[0]).to_equal(previous)
+        expect(tree.documents[0].tags).to_include('atag')
+        expect(tree.documents[0].tags).Not.to_include('dtag')
+
+@Vows.batch
+class InstrumentingTheBuild(Vows.Context):
+    def topic(self):
+        directory = tempfile.mkdtemp()
+        fileNames = writePosts(directory, 5)
+        instruments = Instruments(profile=True)
+        previous = setInstruments(instruments)
+        try:
+            tree = buildDocumentTree(directory, baseURL="/blog/")
+            tree.updateRelated()
+            generateTagResourcesHTML(tree, tree.tags, os.path.join(directory, "tags"))
+        finally:
+            setInstruments(previous)
+        sizes = sum([os.path.getsize(fileName) for fileName in fileNames])
+        shutil.rmtree(directory)
+        return instruments, tree, sizes
+
+    def every_stage_is_timed(self, topic):
+        instruments, tree, sizes = topic
+        expect(instruments.stages.keys()).to_be_like(['scan', 'parse', 'updateRelated', 'generateTagResourcesHTML'])
+
+    def files_and_bytes_read_are_counted(self, topic):
+        instruments, tree, sizes = topic
+        expect(instruments.counters['filesRead']).to_equal(5)
+        expect(instruments.counters['bytesRead']).to_equal(sizes)
+
+    def tag_pages_written_are_counted(self, topic):
+        instruments, tree, sizes = topic
+        expect(instruments.counters['tagPages']).to_equal(len(tree.tags))
+        expect(instruments.counters['filesWritten']).to_equal(len(tree.tags))
+
+    def slowest_stage_is_profiled(self, topic):
+        instruments, tree, sizes = topic
+        slowest = max(instruments.stages, key=lambda name: instruments.stages[name][0])
+        expect(instruments.profileStage).to_equal(slowest)
+        expect(instruments.profileStats).not_to_be_null()
+
+    def summary_has_every_stage_and_counter(self, topic):
+        instruments, tree, sizes = topic
+        summary = instruments.summary()
+        for name in instruments.stages.keys() + instruments.counters.keys():
+            expect(summary).to_include(name)
+        expect(json.loads(instruments.toJSON())['counters']['documents']).to_equal(5)
+
+    def nothing_is_recorded_once_uninstalled(self, topic):
+        expect(tagging.INSTRUMENTS).to_be_instance_of(NullInstruments)
+
 @Vows.batch
 class ReadingDocument(Vows.Context):
     class ProcessingHeadSection(Vows.Context):
@@ -257,3 +1318,27 @@ class ReadingDocument(Vows.Context):
 
         def should_find_excerpt(self, topic):
             expect(topic.excerpt).to_equal("some text goes here")
+
+    class ParsingWithDocumentParser(Vows.Context):
+        def topic(self):
+            return DocumentParser()
+
+        def finds_tags_at_any_link(self, parser):
+            expect(parser.extractTagsFromBody("[x] [[a-tag a]] [[[b b]] [[c\nc]]")).to_equal(('a-tag', 'b', 'c'))
+
+        def adjacent_links_find_the_last_tag(self, parser):
+            expect(parser.extractTagsFromBody("[[atag a]][[btag b]]")).to_equal(('btag',))
+
+        def dates_with_seconds_are_found(self, parser):
+            expect(parser.extractDate("meta-creation_date: 01/31/2012 10:20:30")).to_equal(datetime(2012, 1, 31, 10, 20, 30))
+
+        def dates_without_time_are_found(self, parser):
+            expect(parser.extractDate("meta-creation_date: 1/31/2012")).to_equal(datetime(2012, 1, 31))
+
+        def invalid_dates_are_rejected(self, parser):
+            try:
+                parser.extractDate("meta-creation_date: 2/30/2012 10:20")
+                rejected = False
+            except Exception:
+                rejected = True
+            expect(rejected).to_be_true()